@@ -457,11 +457,12 @@ def file_touch(file_name):
 
     :param str file_name: name of the file whose timestamp is to be modified
     """
-    ts = time.time()
-    os.utime(file_name, ( ts, ts ))
+    # integer nanoseconds, so there is no float rounding
+    ts = time.time_ns()
+    os.utime(file_name, ns = ( ts, ts ))
 
 
-def hash_file(hash_object, filepath, blk_size = 8192):
+def hash_file(hash_object, filepath, blk_size = 1024 * 1024):
     """
     Run a the contents of a file though a hash generator.
 
@@ -470,9 +471,22 @@ def hash_file(hash_object, filepath, blk_size = 8192):
     :param int blk_size: read the file in chunks of that size (in bytes)
     """
     assert hasattr(hash_object, "update")
-    with open(filepath, 'rb') as f:
-        for chunk in iter(lambda: f.read(blk_size), b''):
-            hash_object.update(chunk)
+    with open(filepath, 'rb', buffering = 0) as f:
+        if hasattr(os, "posix_fadvise"):
+            # we read it once start to end, so let the kernel read
+            # ahead more aggressively
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        # read into the same buffer over and over; big chunks keep
+        # the calls into hashlib few (and it drops the GIL for each).
+        # Not mmap()ing the file: if it gets truncated while we hash
+        # it (eg: uploaded again), we'd get a SIGBUS and die.
+        buf = bytearray(blk_size)
+        view = memoryview(buf)
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            hash_object.update(view[:size])
     return hash_object
 
 
@@ -2903,6 +2917,27 @@ class fsdb_c(object):
         assert isinstance(value, (NoneType, str, int, float, bool)), \
             f"value must be None, str, int, float, bool; got {type(value)}"
 
+    def set_many(self, d, force = True):
+        """
+        Set multiple keys in the database
+
+        Each key is set as with :meth:`set` (so each set is atomic,
+        but not the whole operation); implementations can override
+        this to do it more efficiently.
+
+        :param dict d: dictionary of keys and values to set
+
+        :param bool force: (optional; default *True*) if a key exists,
+          force the new value
+
+        :return bool: *True* if all the new values were set
+          correctly; *False* if any key already existed and *force*
+          is *False*.
+        """
+        r = True
+        for key, value in d.items():
+            r &= self.set(key, value, force = force)
+        return r
 
     def get(self, key, default = None):
         """
@@ -3067,8 +3102,15 @@ class fsdb_symlink_c(fsdb_c):
         # at the same time; they can override each other, that's
         # ok--the last one wins.
         location_new = location + "-" + str(os.getpid())
-        rm_f(location_new)
-        os.symlink(value, location_new)
+        try:
+            os.symlink(value, location_new)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            # leftover from a process with our PID that died before
+            # renaming it; rare, so only wipe it when we find it
+            rm_f(location_new)
+            os.symlink(value, location_new)
         os.rename(location_new, location)
         return True
 
@@ -9,20 +9,97 @@
 Common utilities for test cases
 """
 
-import collections
+import base64
+import collections.abc
+import concurrent.futures
 import datetime
+import mmap
 import os
+import random
 import re
+import socket
 import ssl
+import string
+import sys
+import threading
 import time
 import traceback
 import urllib.parse
+import zlib
 
 import pyte
 
 import commonl
 import tcfl.tc
 
+# control characters pyte would interpret; CR and LF are not here
+# because CRLF is handled by the plain text fast path
+_ansi_render_ctl_regex = re.compile("[\x00-\x09\x0b\x0c\x0e-\x1f\x7f]")
+
+def _ansi_render_lines(lines):
+    # squeeze repeated empty lines, see ansi_render_approx(); strip
+    # each line only once and track if the last one was empty instead
+    # of comparing against a screen-wide line of spaces
+    r = ""
+    last_empty = True
+    skips = 1
+    for line in lines:
+        line = line.rstrip()
+        if not line and last_empty:
+            skips += 1
+            continue
+        if skips > 1:
+            r += f"<RENDERER: skipped {skips} empty lines>\n"
+        skips = 1
+        last_empty = not line
+        r += line + "\n"
+    return r
+
+
+def _ansi_render_approx_plain(s, width, height):
+    # Fast path for ansi_render_approx(): if the string has no escape
+    # sequences or control characters other than CRLF line endings
+    # and it fits in the screen, pyte would just lay it out line by
+    # line, so skip emulating the terminal. Return None if the string
+    # needs the full emulation.
+    if "\x1b" in s or "\x9b" in s or not s.isascii() \
+       or _ansi_render_ctl_regex.search(s):
+        return None
+    crlfs = s.count("\r\n")
+    if s.count("\r") != crlfs or s.count("\n") != crlfs:
+        # lone CRs or LFs move the cursor in ways we don't emulate
+        return None
+    lines = s.split("\r\n")
+    if len(lines) > height:
+        return None			# would scroll
+    for line in lines:
+        if len(line) > width:
+            return None		# would wrap
+    if len(lines) < height:
+        # the rest of the screen would be empty lines
+        lines.append("")
+    return _ansi_render_lines(lines)
+
+
+# pyte screens are big; keep one per thread and size so repeated
+# renders can reuse them; per thread because testcases run in
+# multiple threads
+_ansi_render_tls = threading.local()
+
+def _ansi_render_screen_get(width, height):
+    screens = getattr(_ansi_render_tls, "screens", None)
+    if screens == None:
+        screens = _ansi_render_tls.screens = {}
+    screen = screens.get((width, height), None)
+    if screen == None:
+        screen = pyte.Screen(width, height)
+        screens[(width, height)] = screen
+    else:
+        screen.reset()
+        del screen.savepoints[:]	# reset() doesn't clear these
+    return screen
+
+
 def ansi_render_approx(s, width = 80, height = 2000):
     """
     Does an approximated render of how a string would look on a vt100
@@ -60,26 +137,44 @@ def ansi_render_approx(s, width = 80, height = 2000):
     assert isinstance(s, str)
     assert isinstance(width, int) and width > 20
     assert isinstance(height, int) and height > 20
-    r = ""
-    screen = pyte.Screen(width, height)
+    r = _ansi_render_approx_plain(s, width, height)
+    if r != None:
+        return r
+    screen = _ansi_render_screen_get(width, height)
+    # the stream is cheap, but its parser keeps state (eg: if the
+    # string ends in the middle of an escape sequence), so always
+    # start with a fresh one
     stream = pyte.Stream(screen)
     stream.feed(s)
+    # pyte pads lines with spaces, so an empty one strips to nothing
+    return _ansi_render_lines(screen.display)
 
-    empty_line = width * " "
-    last = empty_line
-    skips = 1
-    for line in screen.display:
-        # skip over repeated empty lines
-        if line == empty_line and line == last:
-            skips += 1
-            continue
-        else:
-            if skips > 1:
-                r += f"<RENDERER: skipped {skips} empty lines>\n"
-            skips = 1
-            last = line
-        r += line.rstrip() + "\n"
-    return r
+
+# netmasks for each possible IPv4 prefix length, so we don't have to
+# compute them on each call
+_ipv4_netmasks = tuple(
+    commonl.ipv4_len_to_netmask_ascii(prefix_len)
+    for prefix_len in range(33))
+
+def _ipxe_ifname_find(ifstat, mac_addr):
+    # Find in the output of iPXE's *ifstat* the *netN* interface name
+    # for a MAC address
+    #
+    # The MAC address is a fixed string, so jump straight to where it
+    # shows and then look back for the interface name at the start of
+    # that line; this way we don't have to split the whole output in
+    # lines (there is a lot of it when there are many interfaces).
+    mac_using = ": %s using" % mac_addr
+    offset = 0
+    while True:
+        offset = ifstat.find(mac_using, offset)
+        if offset == -1:
+            return None
+        line_start = ifstat.rfind("\n", 0, offset) + 1
+        ifname = ifstat[line_start:offset].strip()
+        if ifname.startswith("net") and ifname[3:].isdigit():
+            return ifname
+        offset += len(mac_using)
 
 
 def ipxe_sanboot_url(target, sanboot_url):
@@ -106,7 +201,8 @@ def ipxe_sanboot_url(target, sanboot_url):
     target.power.cycle()
 
     boot_ic = target.kws['pos_boot_interconnect']
-    mac_addr = target.kws['interconnects'][boot_ic]['mac_addr']
+    ic_kws = target.kws['interconnects'][boot_ic]
+    mac_addr = ic_kws['mac_addr']
     tcfl.biosl.boot_network_pxe(
         target,
         # Eg: UEFI PXEv4 (MAC:4AB0155F98A1)
@@ -128,17 +224,13 @@ def ipxe_sanboot_url(target, sanboot_url):
     # before sending these "Ctrl-B" keystrokes in ANSI, but we've seen
     # sometimes the timing window being too tight, so we just blast
     # the escape sequence to the console.
-    target.console.write("\x02\x02")	# use this iface so expecter
-    time.sleep(0.3)
-    target.console.write("\x02\x02")	# use this iface so expecter
-    time.sleep(0.3)
-    target.console.write("\x02\x02")	# use this iface so expecter
+    #
+    # Each write is a round trip to the server, so send them all in a
+    # single burst; iPXE ignores the extra Ctrl-Bs.
+    target.console.write("\x02" * 6)	# use this iface so expecter
     time.sleep(0.3)
     target.expect("Ctrl-B", timeout = 250)
-    target.console.write("\x02\x02")	# use this iface so expecter
-    time.sleep(0.3)
-    target.console.write("\x02\x02")	# use this iface so expecter
-    time.sleep(0.3)
+    target.console.write("\x02" * 4)	# use this iface so expecter
     target.expect("iPXE>")
     prompt_orig = target.shell.shell_prompt_regex
     try:
@@ -152,11 +244,9 @@ def ipxe_sanboot_url(target, sanboot_url):
         # on "Connection timed out", http://ipxe.org...
         target.shell.shell_prompt_regex = "iPXE>"
         kws = dict(target.kws)
-        boot_ic = target.kws['pos_boot_interconnect']
-        mac_addr = target.kws['interconnects'][boot_ic]['mac_addr']
-        ipv4_addr = target.kws['interconnects'][boot_ic]['ipv4_addr']
-        ipv4_prefix_len = target.kws['interconnects'][boot_ic]['ipv4_prefix_len']
-        kws['ipv4_netmask'] = commonl.ipv4_len_to_netmask_ascii(ipv4_prefix_len)
+        ipv4_addr = ic_kws['ipv4_addr']
+        ipv4_prefix_len = ic_kws['ipv4_prefix_len']
+        kws['ipv4_netmask'] = _ipv4_netmasks[ipv4_prefix_len]
 
         # Find what network interface our MAC address is; the
         # output of ifstat looks like:
@@ -184,19 +274,16 @@ def ipxe_sanboot_url(target, sanboot_url):
         #
         # thus we need to match the one that fits our mac address
         ifstat = target.shell.run("ifstat", output = True, trim = True)
-        regex = re.compile(
-            "(?P<ifname>net[0-9]+): %s using" % mac_addr.lower(),
-            re.MULTILINE)
-        m = regex.search(ifstat)
-        if not m:
+        mac_lower = mac_addr.lower()
+        ifname = _ipxe_ifname_find(ifstat, mac_lower)
+        if ifname == None:
             raise tcfl.tc.error_e(
                 "iPXE: cannot find interface name for MAC address %s;"
                 " is the MAC address in the configuration correct?"
-                % mac_addr.lower(),
+                % mac_lower,
                 dict(target = target, ifstat = ifstat,
-                     mac_addr = mac_addr.lower())
+                     mac_addr = mac_lower)
             )
-        ifname = m.groupdict()['ifname']
 
         # static is much faster and we know the IP address already
         # anyway; but then we don't have DNS as it is way more
@@ -293,11 +380,24 @@ def console_dump_on_failure(testcase, alevel = 0):
             target.report_blck("console dump due to blockage",
                                attachments, alevel = alevel)
 
+# call sites (FILE:LINE) of target_ic_kws_get() we already warned about
+_target_ic_kws_get_warned = set()
+
 def target_ic_kws_get(target, ic, keyword, default = None):
-    target.report_info(
-        "DEPRECATED: tcfl.tl.target_ic_kws_get() deprecated in"
-        " favour of target.ic_key_get()",
-        dict(trace = traceback.format_stack()))
+    # formatting the stack is expensive, only do it the first time
+    # we are called from a given place
+    frame = sys._getframe(1)
+    call_site = f"{frame.f_code.co_filename}:{frame.f_lineno}"
+    if call_site not in _target_ic_kws_get_warned:
+        _target_ic_kws_get_warned.add(call_site)
+        target.report_info(
+            "DEPRECATED: tcfl.tl.target_ic_kws_get() deprecated in"
+            " favour of target.ic_key_get()",
+            dict(trace = traceback.format_stack()))
+    else:
+        target.report_info(
+            "DEPRECATED: tcfl.tl.target_ic_kws_get() deprecated in"
+            " favour of target.ic_key_get() (called from " + call_site + ")")
     return target.ic_key_get(ic, keyword, default)
 
 
@@ -329,18 +429,25 @@ def setup_verify_slip_feature(zephyr_client, zephyr_server, _ZEPHYR_BASE):
     assert isinstance(zephyr_server, tcfl.tc.target_c)
     client_cfg = zephyr_client.zephyr.config_file_read()
     server_cfg = zephyr_server.zephyr.config_file_read()
+    if 'CONFIG_SLIP' not in client_cfg and 'CONFIG_SLIP' not in server_cfg:
+        return		# no SLIP needed, no need to scan the Kconfigs
     slip_mac_addr_found = False
     for file_name in [
             os.path.join(_ZEPHYR_BASE, "drivers", "net", "Kconfig"),
             os.path.join(_ZEPHYR_BASE, "drivers", "slip", "Kconfig"),
     ]:
-        if os.path.exists(file_name):
-            with open(file_name, "r") as f:
-                if "SLIP_MAC_ADDR" in f.read():
+        if not os.path.exists(file_name):
+            continue
+        # search the raw bytes, no need to decode the whole Kconfig
+        with open(file_name, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                continue	# can't mmap empty files
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                if mm.find(b"SLIP_MAC_ADDR") != -1:
                     slip_mac_addr_found = True
+                    break
 
-    if ('CONFIG_SLIP' in client_cfg or 'CONFIG_SLIP' in server_cfg) \
-       and not slip_mac_addr_found:
+    if not slip_mac_addr_found:
         raise tcfl.tc.blocked_e(
             "Can't test: your Zephyr kernel in %s lacks support for "
             "setting the SLIP MAC address via configuration "
@@ -371,8 +478,9 @@ def teardown_targets_power_off(testcase):
     you want to keep them on to be able to inspect them.
     """
     assert isinstance(testcase, tcfl.tc.tc_c)
-    for dummy_twn, target  in reversed(list(testcase.targets.items())):
-        target.power.off()
+    # dicts iterate in insertion order and can be reversed directly
+    for twn in reversed(testcase.targets):
+        testcase.targets[twn].power.off()
 
 def tcpdump_enable(ic):
     """
@@ -419,7 +527,8 @@ def tcpdump_collect(ic, filename = None):
     ic.report_info("tcpdump available in file %s" % filename)
 
 
-_os_release_regex = re.compile("^[_A-Z]+=.*$")
+# characters valid in a field name in /etc/os-release
+_os_release_field_chars = frozenset(string.ascii_uppercase + "_")
 
 def linux_os_release_get(target, prefix = ""):
     """
@@ -447,11 +556,13 @@ def linux_os_release_get(target, prefix = ""):
     # parse painfully line by line, this way it might be better at
     # catching corruption in case we had output from kernel or
     # whatever messed up in the output of the command
-    for line in output.split("\n"):
+    for line in output.splitlines():
         line = line.strip()
-        if not _os_release_regex.search(line):
+        # only take FIELD=VALUE lines
+        field, equal, value = line.partition("=")
+        if not equal or not field \
+           or not _os_release_field_chars.issuperset(field):
             continue
-        field, value = line.strip().split("=", 1)
         # remove leading and ending quotes
         os_release[field] = value.strip('"')
 
@@ -460,6 +571,22 @@ def linux_os_release_get(target, prefix = ""):
     return os_release
 
 
+def _linux_distro_get(target):
+    # Return the (distro, distro_version) of the target, reading
+    # /etc/os-release only the first time; linux_os_release_get()
+    # caches them in the target's keywords, which is the per-target
+    # cache that goes away when the target is re-deployed by a new
+    # testcase (and thus might have another OS).
+    kws = target.kws
+    distro = kws.get('linux.distro', None)
+    distro_version = kws.get('linux.distro_version', None)
+    if distro == None or distro_version == None:
+        os_release = linux_os_release_get(target)
+        distro = os_release['ID']
+        distro_version = os_release['VERSION_ID']
+    return distro, distro_version
+
+
 def linux_mount_scratchfs(target,
                           reformat: bool = True, path: str = "/scratch"):
     """
@@ -480,13 +607,18 @@ def linux_mount_scratchfs(target,
     :param str path: (optional; default */scratch*) path where to
       mount the scratch file system.
     """
-    output = target.shell.run("cat /proc/mounts", output = True, trim = True)
-    if ' /scratch ' not in output:
-        # not mounted already
-        if reformat:
-            target.shell.run("mkfs.ext4 -F /dev/disk/by-partlabel/TCF-scratch")
-        target.shell.run(f"mkdir -p {path}")
-        target.shell.run(f"mount /dev/disk/by-partlabel/TCF-scratch {path}")
+    # check in the target if it is already mounted, so we don't have
+    # to bring back and decode all of /proc/mounts through the
+    # console; then do everything else in the same command, stopping
+    # at the first step that fails (eg: don't mount if mkfs failed)
+    cmds = []
+    if reformat:
+        cmds.append("mkfs.ext4 -F /dev/disk/by-partlabel/TCF-scratch")
+    cmds.append(f"mkdir -p {path}")
+    cmds.append(f"mount /dev/disk/by-partlabel/TCF-scratch {path}")
+    target.shell.run(
+        f"grep -qF ' {path} ' /proc/mounts"
+        " || { " + " && ".join(cmds) + "; }")
 
 
 def linux_ssh_root_nopwd(target, prefix = ""):
@@ -540,12 +672,13 @@ def linux_ssh_root_nopwd(target, prefix = ""):
        >>> target.console.setup_preferred()
 
     """
-    target.shell.run('mkdir -p %s/etc/ssh' % prefix)
-    target.shell.run(
-        f'grep -qe "^PermitRootLogin yes" {prefix}/etc/ssh/sshd_config'
-        f' || echo "PermitRootLogin yes" >> {prefix}/etc/ssh/sshd_config')
+    # one single command, as each shell.run() has to wait for the
+    # prompt to come back and that is slow in serial consoles
     target.shell.run(
-        f'grep -qe "^PermitEmptyPasswords yes" {prefix}/etc/ssh/sshd_config'
+        f'mkdir -p {prefix}/etc/ssh;'
+        f' grep -qe "^PermitRootLogin yes" {prefix}/etc/ssh/sshd_config'
+        f' || echo "PermitRootLogin yes" >> {prefix}/etc/ssh/sshd_config;'
+        f' grep -qe "^PermitEmptyPasswords yes" {prefix}/etc/ssh/sshd_config'
         f' || echo "PermitEmptyPasswords yes" >> {prefix}/etc/ssh/sshd_config')
 
 
@@ -576,28 +709,29 @@ def linux_sshd_restart(ic, target):
     target.tunnel.ip_addr = target.addr_get(ic, "ipv4")
     target.shell.run("systemctl restart sshd")
     target.shell.run(		# wait for sshd to fully restart
-        # this assumes BASH
+        # this assumes BASH; poll often, sshd is usually back quick
         "while ! exec 3<>/dev/tcp/localhost/22; do"
-        " sleep 1s; done", timeout = 15)
-    time.sleep(2)	# SSH settle
+        " sleep 0.1s; done", timeout = 15)
     # force the SSH tunnel on 22 being re-created -- since it might be
     # toast...bit it will distirb ithir thrids? we just restarted
     # sshd. They were disturbed
-    last_e = None
-    for _count in range(4):
+    #
+    # Instead of waiting a fixed time for SSH to settle, retry with
+    # an exponential backoff (0.25, 0.5, 1s...)
+    top = 4
+    for count in range(top):
         try:
             target.tunnel.remove(22)
             target.ssh.check_call("echo Checking SSH tunnel is up")
             break
         except tcfl.error_e as e:
-            last_e = e
             data = e.attachments
             target.report_info(
                 f"SSH tunnel not up: SSH returned {data['returncode']}",
                 e.attachments)
-            continue
-    else:
-        raise last_e
+            if count == top - 1:
+                raise
+            time.sleep(0.25 * 2 ** count)
 
 
 def linux_ipv4_addr_get_from_console(target, ifname):
@@ -632,11 +766,17 @@ def linux_ipv4_addr_get_from_console(target, ifname):
 
     """
     output = target.shell.run("ip addr show dev %s" % ifname, output = True)
-    regex = re.compile(r"^    inet (?P<name>([0-9\.]+){4})/", re.MULTILINE)
-    matches = regex.search(output)
-    if not matches:
-        raise tcfl.tc.error_e("can't find IP addr")
-    return matches.groupdict()['name']
+    # look for the first line in the form
+    #
+    ##    inet 192.168.1.3/24 brd 192.168.1.255 scope global ...
+    for line in output.splitlines():
+        line = line.lstrip()
+        if not line.startswith("inet "):
+            continue
+        addr, slash, _ = line[5:].partition("/")
+        if slash and addr:
+            return addr
+    raise tcfl.tc.error_e("can't find IP addr")
 
 def sh_export_proxy(ic, target):
     """
@@ -652,25 +792,29 @@ def sh_export_proxy(ic, target):
 
     would yield a command such as::
 
-       $ export  http_proxy=http://192.168.98.1:8888 \
+       $ export http_proxy=http://192.168.98.1:8888 \
+          HTTP_PROXY=http://192.168.98.1:8888 \
           https_proxy=http://192.168.98.1:8888 \
-          no_proxy=127.0.0.1,192.168.98.1/24,fd:00:62::1/104 \
-          HTTP_PROXY=$http_proxy \
-          HTTPS_PROXY=$https_proxy \
-          NO_PROXY=$no_proxy
+          HTTPS_PROXY=http://192.168.98.1:8888 \
+          no_proxy=127.0.0.1,localhost,192.168.98.1/24,fd:00:62::1/104 \
+          NO_PROXY=127.0.0.1,localhost,192.168.98.1/24,fd:00:62::1/104
 
     being executed in the target
 
     """
-    proxy_cmd = ""
+    # build a single export command, since each shell.run() is a
+    # round trip waiting for the prompt; note we can't use
+    # HTTP_PROXY=$http_proxy, as all the arguments to export are
+    # expanded before any is assigned.
+    exports = []
     proxy_hosts = {}
     if 'http_proxy' in ic.kws:
-        target.shell.run("export http_proxy=%(http_proxy)s; "
-                          "export HTTP_PROXY=$http_proxy" % ic.kws)
+        exports.append("http_proxy=%(http_proxy)s"
+                       " HTTP_PROXY=%(http_proxy)s" % ic.kws)
         proxy_hosts['http_proxy'] = ic.kws['http_proxy']
     if 'https_proxy' in ic.kws:
-        target.shell.run("export https_proxy=%(https_proxy)s; "
-                         "export HTTPS_PROXY=$https_proxy" % ic.kws)
+        exports.append("https_proxy=%(https_proxy)s"
+                       " HTTPS_PROXY=%(https_proxy)s" % ic.kws)
         proxy_hosts['https_proxy'] = ic.kws['https_proxy']
     if proxy_hosts:
         # if we are setting a proxy, make sure it doesn't do the
@@ -680,9 +824,9 @@ def sh_export_proxy(ic, target):
             no_proxyl += [ "%(ipv4_addr)s/%(ipv4_prefix_len)s" ]
         if 'ipv6_addr' in ic.kws:
             no_proxyl += [ "%(ipv6_addr)s/%(ipv6_prefix_len)s" ]
-        proxy_cmd += " no_proxy=" + ",".join(no_proxyl)
-        target.shell.run("export " + proxy_cmd % ic.kws)
-        target.shell.run("export NO_PROXY=$no_proxy")
+        no_proxy = ",".join(no_proxyl) % ic.kws
+        exports.append(f"no_proxy={no_proxy} NO_PROXY={no_proxy}")
+        target.shell.run("export " + " ".join(exports))
     return proxy_hosts
 
 def sh_proxy_environment(ic, target, prefix = "/"):
@@ -704,8 +848,13 @@ def sh_proxy_environment(ic, target, prefix = "/"):
     # proxy hierarchy as a backup? they are always network specific anyway?
     proxy_hosts = {}
 
+    # each shell.run() is a round trip through the console waiting
+    # for the prompt, which can be slow on serial consoles; so
+    # collect all the commands and run them in a single go
+    cmds = []
+
     if 'ftp_proxy' in ic.kws:
-        target.shell.run(
+        cmds.append(
             "echo -e 'ftp_proxy=%(ftp_proxy)s\nFTP_PROXY=%(ftp_proxy)s'"
             " >> /etc/environment"
             % ic.kws)
@@ -713,7 +862,7 @@ def sh_proxy_environment(ic, target, prefix = "/"):
         proxy_hosts['ftp_proxy'] = ic.kws['ftp_proxy']
 
     if 'http_proxy' in ic.kws:
-        target.shell.run(
+        cmds.append(
             "echo -e 'http_proxy=%(http_proxy)s\nHTTP_PROXY=%(http_proxy)s'"
             " >> /etc/environment"
             % ic.kws)
@@ -722,7 +871,7 @@ def sh_proxy_environment(ic, target, prefix = "/"):
         proxy_hosts['http_proxy'] = ic.kws['http_proxy']
 
     if 'https_proxy' in ic.kws:
-        target.shell.run(
+        cmds.append(
             "echo -e 'https_proxy=%(https_proxy)s\nHTTPS_PROXY=%(https_proxy)s'"
             " >> /etc/environment"
             % ic.kws)
@@ -731,21 +880,13 @@ def sh_proxy_environment(ic, target, prefix = "/"):
         proxy_hosts['https_proxy'] = ic.kws['https_proxy']
 
     if 'no_proxy' in ic.kws:
-        target.shell.run("echo 'export NO_PROXY=%(no_proxy)s"
-                         " no_proxy=%(no_proxy)s' >> ~/.bashrc" % ic.kws)
-    if apt_proxy_conf:
-        target.shell.run(
-            "test -d /etc/apt/apt.conf.d"
-            " && cat > /etc/apt/apt.conf.d/tcf-proxy.conf <<EOF\n"
-            "Acquire {\n"
-            + "\n".join(apt_proxy_conf) +
-            "}\n"
-            "EOF")
+        cmds.append("echo 'export NO_PROXY=%(no_proxy)s"
+                    " no_proxy=%(no_proxy)s' >> ~/.bashrc" % ic.kws)
 
     # there is no way to distinguis https vs http so we need to make a
     # wild guess by overriding
     if dnf_proxy:
-        target.shell.run(
+        cmds.append(
             "rm -f /tmp/dnf.conf; test -r /etc/dnf/dnf.conf"
             # sed's -n and -i don't play well, so copy it to post-process
             f" && cp /etc/dnf/dnf.conf /tmp/dnf.conf"
@@ -753,6 +894,22 @@ def sh_proxy_environment(ic, target, prefix = "/"):
             # hack: assumes [main] section is the only one
             f" && sed -n -e '/^proxy=/!p' -e '$aproxy={dnf_proxy}' /tmp/dnf.conf > /etc/dnf/dnf.conf")
 
+    # the here document has to go last, since its body starts in
+    # the line after the command line
+    heredoc = ""
+    if apt_proxy_conf:
+        cmds.append(
+            "test -d /etc/apt/apt.conf.d"
+            " && cat > /etc/apt/apt.conf.d/tcf-proxy.conf <<EOF")
+        heredoc = \
+            "\nAcquire {\n" \
+            + "\n".join(apt_proxy_conf) + \
+            "}\n" \
+            "EOF"
+
+    if cmds:
+        target.shell.run("; ".join(cmds) + heredoc)
+
     return proxy_hosts
 
 
@@ -770,15 +927,17 @@ def linux_wait_online(ic, target, loops = 20, wait_s = 0.5):
         "argument 'ic' shall be an interconnect/network target"
     assert loops > 0
     assert wait_s > 0
+    # ip -br prints the addresses as ADDR/PREFIXLEN, so we can match
+    # the whole address; don't print anything while waiting, as it
+    # just costs another process per iteration
     target.shell.run(
         "for i in {1..%d}; do"
-        " hostname -I | grep -Fq %s && break;"
-        " date +'waiting %.1f @ %%c';"
+        " ip -br -4 addr | grep -Fq ' %s/' && break;"
         " sleep %.1fs;"
         "done; "
-        "hostname -I "
+        "ip -br -4 addr "
         "# block until the expected IP is assigned, we are online"
-        % (loops, target.addr_get(ic, "ipv4"), wait_s, wait_s),
+        % (loops, target.addr_get(ic, "ipv4"), wait_s),
         timeout = (loops + 1) * wait_s)
 
 
@@ -803,6 +962,168 @@ def linux_wait_host_online(target, hostname, loops = 20):
         timeout = (loops + 1) * 3 * 1)
 
 
+# This lists all the files in the path recursively, sorting
+# them by oldest modification time first.
+#
+# In Python? Why? because it is much faster than doing it in
+# shell when there are very large trees with many
+# files. This needs Python 3.7 or later.
+#
+# This is run as 'python3 -c' with the path and the size
+# to shrink to (in bytes) as arguments; see
+# linux_rsync_cache_lru_cleanup() on how it is sent.
+#
+# Each entry is a tuple with the mtime, the size, the name and
+# if it is a directory.
+#
+# We want to keep the newest entries whose accumulated size
+# fits in what we have been asked to shrink to and wipe the
+# rest. Instead of listing everything and then sorting it,
+# we keep what fits so far in a heap, oldest on top: when
+# adding an entry makes it too big, we drop the oldest
+# entries until it fits again. Anything older than an entry
+# we dropped is dropped right away, since it can't fit
+# anymore. So we only sort what we keep.
+#
+# Then we wipe all the files we dropped and then the
+# directories, deepest first, so we shall be able to
+# remove empty dirs. If they were actually needed, they'll
+# be brought back by rsync at low cost. Files are removed
+# from a pool of threads, so the storage has multiple
+# requests in flight (os.unlink() releases the GIL); each
+# thread takes a directory and removes its files relative to
+# it, so the kernel doesn't have to look up the whole path for
+# each;
+# directories are cheap and have to go in order, so they are
+# done serially once all the files are gone. We count how many
+# entries each directory had when we walked it and how many of
+# them we removed, so we only try to remove those that are
+# empty.
+#
+# We use statvfs() to get the filesystem's block size to
+# approximate the actual space used in the disk
+# better. Still kinda naive. The block size is a power of
+# two, so rounding up to it is just masking.
+#
+# walk: walk depth first with scandir(), so if we rm all the
+# files in a dir, the dir is empty and we will wipe it too
+# after wiping the files. scandir() gives us the entry type
+# from the directory listing and DirEntry.stat() doesn't
+# have to resolve the whole path again, so it is way faster
+# than os.walk() + os.stat() in large trees. Scanning each
+# subdirectory from a file descriptor opened relative to its
+# parent's, makes the kernel look up only the entry's name
+# rather than the whole path every time. We don't follow
+# symlinks, so dangling ones are just removed like
+# files. OSError will likely be something we can't find or
+# access, so we ignore it.
+#
+# And don't print anything...takes too long for large trees
+_linux_rsync_cache_lru_cleanup_py = """
+import concurrent.futures, heapq, os, sys
+
+path = sys.argv[1]
+sc = int(sys.argv[2])
+kept = []
+kept_size = 0
+cutoff = None
+rm = []
+children = {}
+
+def account(e):
+    global kept_size, cutoff
+    if cutoff != None and e[0] <= cutoff:
+        rm.append(e)
+        return
+    heapq.heappush(kept, e)
+    kept_size += e[1]
+    while kept_size > sc:
+        oldest = heapq.heappop(kept)
+        kept_size -= oldest[1]
+        if cutoff == None or oldest[0] > cutoff:
+            cutoff = oldest[0]
+        rm.append(oldest)
+
+def walk(dir_fd, path, _account = account, _open = os.open):
+    mask = fsbmask
+    count = 0
+    with os.scandir(dir_fd) as it:
+        for e in it:
+            count += 1
+            try:
+                s = e.stat(follow_symlinks = False)
+                is_dir = e.is_dir(follow_symlinks = False)
+            except OSError:
+                continue
+            entry_path = path + '/' + e.name
+            if is_dir:
+                try:
+                    fd = _open(e.name, os.O_RDONLY | os.O_DIRECTORY, dir_fd = dir_fd)
+                    try:
+                        walk(fd, entry_path)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    pass
+            sd = (s.st_size + mask) & ~mask
+            _account((s.st_mtime, sd, entry_path, is_dir))
+    children[path] = count
+
+try:
+    fsbmask = os.statvfs(path).f_bsize - 1
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        walk(fd, path)
+    finally:
+        os.close(fd)
+except OSError:
+    pass
+
+rm_files = {}
+for e in rm:
+    if not e[3]:
+        parent, _, name = e[2].rpartition('/')
+        rm_files.setdefault(parent, []).append(name)
+
+def unlink(parent, names):
+    count = 0
+    try:
+        fd = os.open(parent, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return count
+    try:
+        for name in names:
+            try:
+                os.unlink(name, dir_fd = fd)
+                count += 1
+            except OSError:
+                pass
+    finally:
+        os.close(fd)
+    return count
+
+with concurrent.futures.ThreadPoolExecutor(max_workers = 16) as executor:
+    removed = dict(zip(rm_files.keys(),
+                       executor.map(unlink, rm_files.keys(), rm_files.values())))
+
+for e in sorted(rm, key = lambda e: e[2].count('/'), reverse = True):
+    if not e[3] or removed.get(e[2], 0) != children.get(e[2], -1):
+        continue
+    try:
+        os.rmdir(e[2])
+    except OSError:
+        continue
+    parent = e[2].rpartition('/')[0]
+    removed[parent] = removed.get(parent, 0) + 1
+"""
+
+# the program above, compressed and base64 encoded so it can be
+# passed to 'python3 -c' in a single command line
+_linux_rsync_cache_lru_cleanup_b64 = base64.b64encode(
+    zlib.compress(_linux_rsync_cache_lru_cleanup_py.encode('utf-8'), 9)
+).decode('ascii')
+
+
 def linux_rsync_cache_lru_cleanup(target, path, max_kbytes):
     """Cleanup an LRU rsync cache in a path in the target
 
@@ -825,97 +1146,21 @@ def linux_rsync_cache_lru_cleanup(target, path, max_kbytes):
     assert isinstance(path, str)
     assert max_kbytes > 0
 
-    testcase = target.testcase
     target.report_info(
         "rsync cache: reducing %s to %dMiB" % (path, max_kbytes / 1024.0))
 
-    prompt_original = target.shell.prompt_regex
-    python_error_ex = target.console.text(
-        re.compile("^(.*Error|Exception):.*^>>> ", re.MULTILINE | re.DOTALL),
-        name = "python error",
-        timeout = 0, poll_period = 1,
-        raise_on_found = tcfl.tc.error_e("error detected in python"))
-    testcase.expect_tls_append(python_error_ex)
-    try:
-        target.send("TTY=dumb python || python2 || python3")	 # launch python!
-        # This lists all the files in the path recursively, sorting
-        # them by oldest modification time first.
-        #
-        # In Python? Why? because it is much faster than doing it in
-        # shell when there are very large trees with many
-        # files. Make sure it is 2 and 3 compat.
-        #
-        # Note we are feeding lines straight to the python
-        # interpreter, so we need an extra newline for each
-        # indented block to close them.
-        #
-        # The list includes the mtime, the size and the name  (not using
-        # bisect.insort() because it doesn't support an insertion key
-        # easily).
-        #
-        # Then start iterating newest first until the total
-        # accumulated size exceeds what we have been
-        # asked to free and from there on, wipe all files.
-        #
-        # Note we list directories after the files; since
-        # sorted(), when sorted by mtime is most likely they will
-        # show after their contained files, so we shall be able to
-        # remove empty dirs. Also, sorted() is stable. If they
-        # were actually needed, they'll be brought back by rsync
-        # at low cost.
-        #
-        # We use statvfs() to get the filesystem's block size to
-        # approximate the actual space used in the disk
-        # better. Still kinda naive.
-        #
-        # why not use scandir()? this needs to be able to run in
-        # python2 for older installations.
-        #
-        # walk: walk depth first, so if we rm all the files in a dir,
-        # the dir is empty and we will wipe it too after wiping
-        # the files; if stat fails with FileNotFoundError, that's
-        # usually a dangling symlink; ignore it. OSError will
-        # likely be something we can't find, so we ignore it too.
-        #
-        # And don't print anything...takes too long for large trees
-        target.shell.run("""
-import os, errno, stat
-l = []
-dirs = []
-try:
-    fsbsize = os.statvfs('%(path)s').f_bsize
-    for r, dl, fl in os.walk('%(path)s', topdown = False):
-        for fn in fl + dl:
-            fp = os.path.join(r, fn)
-            try:
-                s = os.stat(fp)
-                sd = fsbsize * ((s.st_size + fsbsize - 1) / fsbsize)
-                l.append((s.st_mtime, sd, fp, stat.S_ISDIR(s.st_mode)))
-            except (OSError, FileNotFoundError) as x:
-                pass
-except (OSError, FileNotFoundError) as x:
-    pass
-
-
-acc = 0
-sc = %(max_bytes)d
-for e in sorted(l, key = lambda e: e[0], reverse = True):
-    acc += e[1]
-    if acc > sc:
-        if e[3]:
-            try:
-                os.rmdir(e[2])
-            except OSError as x:
-                if x.errno == errno.ENOTEMPTY:
-                    pass
-        else:
-            os.unlink(e[2])
-
-
-exit()""" % dict(path = path, max_bytes = max_kbytes * 1024))
-    finally:
-        target.shell.prompt_regex = prompt_original
-        testcase.expect_tls_remove(python_error_ex)
+    # Send the program in a single line; typing it line by line
+    # into an interactive interpreter means echo and a round trip
+    # per line over the console, which can be slow.
+    #
+    # If it fails, python exits with non-zero and the shell's error
+    # detection catches it.
+    target.shell.run(
+        "$(command -v python3 || command -v python) -c"
+        " \"import base64, zlib;"
+        " exec(zlib.decompress(base64.b64decode('%s')))\""
+        " '%s' %d"
+        % (_linux_rsync_cache_lru_cleanup_b64, path, max_kbytes * 1024))
 
 #
 # Well, so this is a hack anyway; we probably shall replace this with
@@ -990,6 +1235,10 @@ swupd_bundle_add_timeouts = {
     'texlive': 1000, #1061
 }
 
+# duration of a bundle-add, as reported by *time -p*
+_swupd_kpi_regex = re.compile(r"^real[ \t]+(?P<seconds>[\.0-9]+)$",
+                              re.MULTILINE)
+
 def swupd_bundle_add(ic, target, bundle_list,
                      debug = None, url = None,
                      wait_online = True, set_proxy = True,
@@ -1079,10 +1328,15 @@ def swupd_bundle_add(ic, target, bundle_list,
     if isinstance(bundle_list, str):
         bundle_list = [ bundle_list ]
     else:
-        assert isinstance(bundle_list, collections.Iterable) \
-            and all(isinstance(item, str) for item in bundle_list), \
+        assert isinstance(bundle_list, collections.abc.Iterable), \
             "bundle_list must be a string (bundle name) or list " \
             "of bundle names, got a %s" % type(bundle_list).__name__
+        # each bundle-add is expensive, so don't do the same twice
+        # (keeping the order)
+        bundle_list = list(dict.fromkeys(bundle_list))
+        assert all(isinstance(item, str) for item in bundle_list), \
+            "bundle_list must be a string (bundle name) or list " \
+            "of bundle names; some items are not strings"
 
     if debug == None:
         debug = 'SWUPD_DEBUG' in os.environ
@@ -1159,8 +1413,8 @@ def swupd_bundle_add(ic, target, bundle_list,
         # that it lists all the bundles it has to download and their sizes
         # so we can dynamically adjust this
         if add_timeout == None:
-            if bundle in swupd_bundle_add_timeouts:
-                _add_timeout = swupd_bundle_add_timeouts[bundle]
+            _add_timeout = swupd_bundle_add_timeouts.get(bundle, None)
+            if _add_timeout != None:
                 target.report_info(
                     "bundle-add: adjusting timeout to %d per configuration "
                     "tcfl.tl.swupd_bundle_add_timeouts" % _add_timeout)
@@ -1190,15 +1444,25 @@ def swupd_bundle_add(ic, target, bundle_list,
                 break
             if 'Error: Bundle too large by' in output:
                 df = target.shell.run("df -h", output = True, trim = True)
-                du = target.shell.run("du -hsc /persistent.tcf.d/*",
-                                      output = True, trim = True)
+                # du has to walk the tree that filled up the disk,
+                # which can take a long time; we only want a hint,
+                # so don't let it delay reporting the failure
+                du = target.shell.run(
+                    "timeout 30 du -hsc /persistent.tcf.d/* || true",
+                    output = True, trim = True, timeout = 40)
                 raise tcfl.tc.blocked_e(
                     "swupd reports rootfs out of space to"
                     " install bundle %(bundle)s" % kws,
                     dict(output = output, df = df, du = du))
-            target.report_info("bundle-add: failed %d/%d? Retrying in 5s"
-                               % (count, top))
-            time.sleep(5)
+            if count == top:
+                continue
+            # back off exponentially, so transient failures (eg:
+            # another swupd holding the lock) retry quick; jitter so
+            # targets sharing a mirror don't all retry at once
+            backoff = min(2 ** (count - 1), 10) + random.uniform(0, 1)
+            target.report_info("bundle-add: failed %d/%d? Retrying in %.1fs"
+                               % (count, top, backoff))
+            time.sleep(backoff)
         else:
             # match below's
             target.report_data("swupd bundle-add retries",
@@ -1206,12 +1470,10 @@ def swupd_bundle_add(ic, target, bundle_list,
             raise tcfl.tc.error_e("bundle-add failed too many times")
 
         # see above on time -p
-        kpi_regex = re.compile(r"^real[ \t]+(?P<seconds>[\.0-9]+)$",
-                               re.MULTILINE)
-        m = kpi_regex.search(output)
+        m = _swupd_kpi_regex.search(output)
         if not m:
             raise tcfl.tc.error_e(
-                "Can't find regex %s in output" % kpi_regex.pattern,
+                "Can't find regex %s in output" % _swupd_kpi_regex.pattern,
                 dict(output = output))
         # maybe domain shall include the top level image type
         # (clear:lts, clear:desktop...)
@@ -1231,6 +1493,20 @@ def linux_time_set(target):
                      % str(datetime.datetime.utcnow()))
 
 
+def _sh_cmd_args(cmd, args, max_args = 20):
+    # Return the command line (and here document, if any) to run CMD
+    # ARG1 ARG2...
+    #
+    # With many arguments the command line gets very long, which is
+    # slow to echo back over a serial console and can go over the
+    # terminal's line length limit; in that case, have xargs read
+    # them, one per line, from a here document that has to be
+    # appended after the command line.
+    if len(args) <= max_args:
+        return cmd + " " + " ".join(args), ""
+    return "xargs -r " + cmd + " <<EOF", "\n" + "\n".join(args) + "\nEOF"
+
+
 def linux_package_add(ic, target, *packages,
                       timeout = 120, fix_time = True,
                       proxy_wait_online = True,
@@ -1288,15 +1564,7 @@ def linux_package_add(ic, target, *packages,
             "value %s must be a list of strings;" \
             " some items in the list are not" % key
 
-    if not 'linux.distro' in target.kws or not 'linux.distro_version' in target.kws:
-        os_release = linux_os_release_get(target)
-        distro = os_release['ID']
-        distro_version = os_release['VERSION_ID']
-        target.kw_set("linux.distro", distro)
-        target.kw_set("linux.distro_version", distro_version)
-    else:
-        distro = target.kws['linux.distro']
-        distro_version = target.kws['linux.distro_version']
+    distro, distro_version = _linux_distro_get(target)
 
     if fix_time:
         # if the clock is messed up, SSL signing won't work for some things
@@ -1304,13 +1572,15 @@ def linux_package_add(ic, target, *packages,
                          % str(datetime.datetime.utcnow()))
 
     if proxy_wait_online:
-        proxy_hosts = set()
-        if 'ftp_proxy' in ic.kws:
-            proxy_hosts.add(urllib.parse.urlparse(ic.kws['ftp_proxy']).hostname)
-        if 'http_proxy' in ic.kws:
-            proxy_hosts.add(urllib.parse.urlparse(ic.kws['http_proxy']).hostname)
-        if 'https_proxy' in ic.kws:
-            proxy_hosts.add(urllib.parse.urlparse(ic.kws['https_proxy']).hostname)
+        # most of the time the proxies are all the same URL, so
+        # only parse each different one once
+        proxy_urls = set()
+        for key in ( 'ftp_proxy', 'http_proxy', 'https_proxy' ):
+            url = ic.kws.get(key, None)
+            if url:
+                proxy_urls.add(url)
+        proxy_hosts = set(
+            urllib.parse.urlsplit(url).hostname for url in proxy_urls)
         if proxy_hosts:
             target.report_info(
                 f"waiting for proxies to be online (ping): {', '.join(proxy_hosts)}")
@@ -1327,32 +1597,38 @@ def linux_package_add(ic, target, *packages,
     elif distro == 'centos':
         _packages = packages + kws.get("any", []) + kws.get("centos", [])
         if _packages:
-            target.shell.run("dnf install -qy " +  " ".join(_packages),
-            timeout = timeout)
+            cmd, heredoc = _sh_cmd_args("dnf install -qy", _packages)
+            target.shell.run(cmd + heredoc, timeout = timeout)
     elif distro == 'fedora':
         _packages = packages + kws.get("any", []) + kws.get("fedora", [])
         if _packages:
-            target.shell.run(
-                "dnf install --releasever %s -qy " % distro_version
-                +  " ".join(_packages),
-                timeout = timeout)
+            cmd, heredoc = _sh_cmd_args(
+                "dnf install --releasever %s -qy" % distro_version,
+                _packages)
+            target.shell.run(cmd + heredoc, timeout = timeout)
     elif distro == 'rhel':
         _packages = packages + kws.get("any", []) + kws.get("rhel", [])
         if _packages:
-            target.shell.run("dnf install -qy " +  " ".join(_packages),
-                             timeout = timeout)
+            cmd, heredoc = _sh_cmd_args("dnf install -qy", _packages)
+            target.shell.run(cmd + heredoc, timeout = timeout)
     elif distro == 'ubuntu':
         _packages = packages + kws.get("any", []) + kws.get("ubuntu", [])
         if _packages:
             # FIXME: add needed repos [ubuntu|debian]_extra_repos
+            #
+            # All in one go to save console round trips; run in a
+            # subshell so if any step fails, the subshell fails and
+            # trips the shell's error trap (which doesn't fire for
+            # commands in the middle of an && list).
+            cmd, heredoc = _sh_cmd_args("apt-get install -qy", _packages)
             target.shell.run(
-                "sed -i 's/main restricted/main restricted universe multiverse/'"
-                " /etc/apt/sources.list")
-            target.shell.run("apt-get -qy update", timeout = timeout)
-            target.shell.run(
-                "DEBIAN_FRONTEND=noninteractive"
-                " apt-get install -qy " +  " ".join(_packages),
-                timeout = timeout)
+                "("
+                " sed -i 's/main restricted/main restricted universe multiverse/'"
+                " /etc/apt/sources.list"
+                " && apt-get -qy update"
+                " && DEBIAN_FRONTEND=noninteractive " + cmd +
+                " )" + heredoc,
+                timeout = 2 * timeout)
     else:
         raise tcfl.tc.error_e("unknown OS: %s %s (from /etc/os-release)"
                               % (distro, distro_version))
@@ -1395,6 +1671,20 @@ tap_mapping_result_c = {
     'todo': tcfl.result_c(errors = 1),
 }
 
+# Each TAP line is one of a plan (1..N), a testcase result, the
+# version header or output (# DATA); they are all matched with a
+# single regex and then we look at which group matched.
+_tap_line_regex = re.compile(
+    r"^(?:"
+    r"(?P<plan_min>[0-9]+)\.\.(?P<plan_max>[0-9]+)"
+    r"|(?P<result>(ok |not ok ))(?P<plan_count>[0-9]+ )?"
+    r"-\w*(?P<subject>[^#]*)?(#(?P<directive>.*))?"
+    r"|TAP version (?P<tap_version>[0-9]+)"
+    r"|#(?P<data>.*)"
+    r")$")
+_tap_skip_regex = re.compile(r"skip(ped)?:?", re.IGNORECASE)
+_tap_todo_regex = re.compile(r"todo:?", re.IGNORECASE)
+
 def tap_parse_output(output_itr):
     """
     Parse `TAP
@@ -1410,14 +1700,6 @@ def tap_parse_output(output_itr):
        - directive: if any directive was found, the text for it
        - output: output specific to this testcase
     """
-    tap_version = re.compile("^TAP version (?P<tap_version>[0-9]+)$")
-    tc_plan = re.compile(r"^(?P<plan_min>[0-9]+)\.\.(?P<plan_max>[0-9]+)$")
-    tc_line = re.compile(r"^(?P<result>(ok |not ok ))(?P<plan_count>[0-9]+ )?"
-                         r"-\w*(?P<subject>[^#]*)?(#(?P<directive>.*))?$")
-    tc_output = re.compile(r"^#(?P<data>.*)$")
-    skip_regex = re.compile(r"skip(ped)?:?", re.IGNORECASE)
-    todo_regex = re.compile(r"todo:?", re.IGNORECASE)
-
     # state
     _plan_min = None
     _plan_top = None
@@ -1430,8 +1712,10 @@ def tap_parse_output(output_itr):
     tc = None
     for line in output_itr:
         linecnt += 1
-        m = tc_plan.search(line)
-        if m:
+        m = _tap_line_regex.match(line)
+        if not m:
+            continue
+        if m.group('plan_min') != None:
             if plan_set_at and _plan_count > plan_max:
                 # only complain if we have not completed it, otherwise
                 # consider it spurious and ignore
@@ -1441,11 +1725,10 @@ def tap_parse_output(output_itr):
                     f"{linecnt}: setting range, but was already set at {plan_set_at}",
                     dict(line_count = linecnt, line = line))
             plan_set_at = linecnt
-            plan_min = int(m.groupdict()['plan_min'])
-            plan_max = int(m.groupdict()['plan_max'])
+            plan_min = int(m.group('plan_min'))
+            plan_max = int(m.group('plan_max'))
             continue
-        m = tc_line.search(line)
-        if m:
+        if m.group('result') != None:
             d = m.groupdict()
             result = d['result']
             count = d['plan_count']
@@ -1463,14 +1746,13 @@ def tap_parse_output(output_itr):
             directive_sl = directive_s.split()
             if directive_sl:
                 directive = directive_sl[0]
-                if skip_regex.match(directive):
+                if _tap_skip_regex.match(directive):
                     result = "skip"
-                elif todo_regex.match(directive):
+                elif _tap_todo_regex.match(directive):
                     result = "todo"
             else:
                 directive = ''
             tc_current = subject
-            print(f"DEBUG subject is {subject}")
             tcs[subject] = dict(
                 lines = [ linecnt ],
                 plan_count = count,
@@ -1482,18 +1764,14 @@ def tap_parse_output(output_itr):
             # oficially a new testcase in the plan
             _plan_count += 1
             continue
-        m = tap_version.search(line)
-        if m:
-            d = m.groupdict()
-            tap_version = int(d['tap_version'])
+        if m.group('tap_version') != None:
+            tap_version = int(m.group('tap_version'))
             if tap_version < 12:
                 raise RuntimeError("%d: Can't process versions < 12", linecnt)
             continue
-        m = tc_output.search(line)
-        if m:
-            d = m.groupdict()
+        if m.group('data') != None:
             if tc:
-                tc['output'] += d['data'] + "\n"
+                tc['output'] += m.group('data') + "\n"
                 tc['lines'].append(linecnt)
             else:
                 raise tcfl.tc.blocked_e(
@@ -1503,6 +1781,185 @@ def tap_parse_output(output_itr):
     return tcs
 
 
+# (TARGET-FULLID, CERT-NAME) -> (ALLOCID, KEY-PATH, CERT-PATH,
+# SSL-CONTEXT) of the client certificates rpyc_connect() last
+# downloaded
+_rpyc_certs = {}
+_rpyc_certs_lock = threading.Lock()
+
+def _rpyc_cert_file_write(path, data):
+    # Write a client key/certificate file, unless it already has
+    # the same contents; it is key material, so only for us to read
+    data = data.encode('utf-8')
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return
+    except FileNotFoundError:
+        pass
+    # small enough to go in a single write, no need for buffering
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+# (HOSTNAME, PORT, CERT-NAME, ALLOCID, SYNC-TIMEOUT) -> rpyc
+# connection opened by rpyc_connect(); the sync timeout is part of
+# the key since it is set in the connection's configuration, shared
+# by all its users.
+_rpyc_connections = {}
+_rpyc_connections_lock = threading.Lock()
+
+def _rpyc_connections_close(remotes):
+    for remote in remotes:
+        try:
+            remote.close()
+        except Exception:	# pylint: disable = broad-except
+            # it might be dead already, we don't care
+            pass
+
+
+def _rpyc_connection_get(allocid, connection_key):
+    # return the cached connection for connection_key (or None);
+    # evict those to the same component (host and port) opened in
+    # other allocations, which can't be used anymore (they'd keep
+    # sockets and SSL sessions open forever). Note we can't just
+    # evict anything from another allocation, since other testcases
+    # might be running in parallel with their own allocations.
+    with _rpyc_connections_lock:
+        stale = [
+            key for key in _rpyc_connections
+            if key[:2] == connection_key[:2] and key[3] != allocid
+        ]
+        remotes_stale = [ _rpyc_connections.pop(key) for key in stale ]
+        remote = _rpyc_connections.get(connection_key, None)
+    _rpyc_connections_close(remotes_stale)
+    return remote
+
+
+def _rpyc_connection_put(connection_key, remote, remote_old):
+    # record the newly opened connection, unless some other thread
+    # connected in the meantime, in which case we use theirs and close
+    # ours, so it doesn't leak
+    with _rpyc_connections_lock:
+        remote_cached = _rpyc_connections.get(connection_key, None)
+        if remote_cached != None and remote_cached is not remote_old \
+           and not remote_cached.closed:
+            remote_new = remote_cached
+            remotes_close = [ remote ]
+        else:
+            _rpyc_connections[connection_key] = remote
+            remote_new = remote
+            remotes_close = [ remote_old ] if remote_old != None else []
+    _rpyc_connections_close(remotes_close)
+    return remote_new
+
+
+def _rpyc_connection_alive(remote):
+    if remote.closed:
+        return False
+    try:
+        remote.ping(timeout = 3)
+        return True
+    except Exception:	# pylint: disable = broad-except
+        # whatever it is, we can't use it
+        return False
+
+
+def _rpyc_stream_connect(rpyc, hostname, rpyc_port, context):
+    # Connect to an rpyc server over SSL with the given SSL context;
+    # same connection timeout rpyc.utils.classic.ssl_connect() uses.
+    #
+    # rpyc is lots of small requests and replies back and forth, so
+    # don't let Nagle's algorithm hold them waiting for more
+    # data. Socket buffer sizes are left for the kernel to autotune.
+    sock = socket.create_connection(( hostname, rpyc_port ), 3)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        ssl_sock = context.wrap_socket(sock, server_hostname = hostname)
+    except BaseException:
+        sock.close()
+        raise
+    return rpyc.utils.classic.connect_stream(
+        rpyc.core.stream.SocketStream(ssl_sock))
+
+
+def _rpyc_connect(rpyc, target, component, cert_name,
+                  rpyc_port, ssl_enabled):
+    # open a new connection for rpyc_connect()
+    hostname = target.rtb.parsed_url.hostname
+    if ssl_enabled:
+        # get the certificate files from the server, unless they are already created
+        client_key_path = os.path.join(target.tmpdir, "client." + cert_name + ".key")
+        client_cert_path = os.path.join(target.tmpdir, "client." + cert_name + ".cert")
+
+        # Certificates are only valid for the allocation they were
+        # issued in, so only reuse the files we wrote if they were
+        # written for this same allocation; otherwise (or if
+        # somebody removed them) get them again from the server.
+        #
+        # The SSL context with them loaded is kept along, so we
+        # don't have to parse them again for each connection.
+        allocid = target.testcase.allocid
+        cache_key = ( target.fullid, cert_name )
+        # serialize, so parallel connects (rpyc_connect_many()) don't
+        # download and write the same files at the same time
+        with _rpyc_certs_lock:
+            cached = _rpyc_certs.get(cache_key, None)
+            if allocid == None \
+               or cached == None \
+               or cached[:3] != ( allocid, client_key_path, client_cert_path ) \
+               or not os.path.isfile(client_key_path) \
+               or not os.path.isfile(client_cert_path):
+                r = target.certs.get(cert_name)
+                _rpyc_cert_file_write(client_key_path, r['key'])
+                _rpyc_cert_file_write(client_cert_path, r['cert'])
+                # same settings rpyc.utils.classic.ssl_connect() uses,
+                # but never go below TLS v1.2 (older Pythons allow it);
+                # TLS v1.3 is negotiated when the server has it.
+                #
+                # Note we don't try to resume TLS sessions: the server
+                # (rpyc's SSLAuthenticator) creates a new SSL context
+                # for each connection, so it never accepts a session
+                # ticket; instead, rpyc_connect() reuses connections.
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                context.minimum_version = ssl.TLSVersion.TLSv1_2
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                context.load_cert_chain(client_cert_path, keyfile = client_key_path)
+                _rpyc_certs[cache_key] = \
+                    ( allocid, client_key_path, client_cert_path, context )
+            else:
+                context = cached[3]
+
+        target.report_info(
+            f"rpyc: SSL-connecting (cert '{cert_name}') to '{component}' on"
+            f" {hostname}:{rpyc_port}"
+            f" (key/cert path {client_key_path})", dlevel = 3)
+        remote = _rpyc_stream_connect(rpyc, hostname, rpyc_port, context)
+        target.report_info(
+            f"rpyc: SSL-connected (cert '{cert_name}') to '{component}' on"
+            f" {hostname}:{rpyc_port}", dlevel = 2)
+    else:
+        target.report_info(
+            f"rpyc: connecting to '{component}' on"
+            f" {hostname}:{rpyc_port}", dlevel = 3)
+        # no client certificate, otherwise as above; this is what
+        # rpyc.utils.classic.ssl_connect() does with no arguments
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        remote = _rpyc_stream_connect(rpyc, hostname, rpyc_port, context)
+        target.report_info(
+            f"rpyc: connected to '{component}' on"
+            f" {hostname}:{rpyc_port}", dlevel = 2)
+    return remote
+
+
 # FIXME: this should declare target is tcfl.tc.target_c but it can't
 # yet because we have an import hell that will be fixed in v0.16
 # - add to target: tcfl.tc.target_c, component: str
@@ -1511,6 +1968,15 @@ def rpyc_connect(target, component: str,
                  iface_name = "power", sync_timeout = 60):
     """Connect to an RPYC component exposed by the target
 
+    Connections are reused: calling again for the same component
+    (and *sync_timeout*) during the same allocation returns the same
+    connection if it is still alive (closing it closes it for all the
+    users). Connections to it from previous allocations are closed.
+
+    Connecting blocks until the TCP connection and SSL handshake are
+    done; to connect to multiple components at the same time, use
+    :func:`rpyc_connect_many`, which overlaps them in threads.
+
     :param tcfl.tc.target_c target: target which exposes the RPYC
       component.
 
@@ -1544,16 +2010,14 @@ def rpyc_connect(target, component: str,
       longer functions, although this will incur a longter time to
       detect network drops.
 
-      As well, it can be done temporarily as:
+      Since connections are shared, don't modify
+      *remote._config['sync_request_timeout']* in a connection
+      returned by this function, as it would change it for all its
+      users; instead, get a connection with a different timeout for
+      the long operations:
 
-      >>> remote = tcfl.tl.rpyc_connect(...)
-      >>> ...
-      >>> timeout_orig = remote._config['sync_request_timeout']
-      >>> try:
-      >>>     remote._config['sync_request_timeout'] = 30 * 60 # 30min
-      >>>     ... run long remote operation...
-      >>> finally:
-      >>>     remote._config['sync_request_timeout'] = timeout_orig
+      >>> remote_long = tcfl.tl.rpyc_connect(..., sync_timeout = 30 * 60)
+      >>> ... run long remote operation on remote_long...
     """
     # FIXME: assert isinstance(target, tcfl.tc.target_c)
     assert isinstance(component, str)
@@ -1566,52 +2030,67 @@ def rpyc_connect(target, component: str,
             "MISSING MODULES: install them with: pip install --user rpyc")
         raise
 
+    hostname = target.rtb.parsed_url.hostname
     rpyc_port = target.kws[f"interfaces.{iface_name}.{component}.rpyc_port"]
     ssl_enabled = target.kws[f"interfaces.{iface_name}.{component}.ssl_enabled"]
-    if ssl_enabled:
-        # get the certificate files from the server, unless they are already created
-        client_key_path = os.path.join(target.tmpdir, "client." + cert_name + ".key")
-        client_cert_path = os.path.join(target.tmpdir, "client." + cert_name + ".cert")
-
-        # FIXME: this needs to be smarter -- it needs to re-download
-        # if the allocid is different; now it is causing way too many
-        # issues when there are files left around (eg: reusing tmp).
-        if True or not os.path.isfile(client_key_path) or not os.path.isfile(client_cert_path):
-            # if we have the certificates int
-            r = target.certs.get(cert_name)
-            with open(client_key_path, "w") as keyf:
-                keyf.write(r['key'])
-            with open(client_cert_path, "w") as certf:
-                certf.write(r['cert'])
-
-        target.report_info(
-            f"rpyc: SSL-connecting (cert '{cert_name}') to '{component}' on"
-            f" {target.rtb.parsed_url.hostname}:{rpyc_port}", dlevel = 3)
-        target.report_info(
-            f"rpyc: using key/cert path {client_key_path}'", dlevel = 4)
-        remote = rpyc.utils.classic.ssl_connect(
-            target.rtb.parsed_url.hostname,
-            port = rpyc_port,
-            keyfile = client_key_path,
-            certfile =  client_cert_path,
-            ssl_version = ssl.PROTOCOL_TLS
-        )
-        target.report_info(
-            f"rpyc: SSL-connected (cert '{cert_name}') to '{component}' on"
-            f" {target.rtb.parsed_url.hostname}:{rpyc_port}", dlevel = 2)
-    else:
-        target.report_info(
-            f"rpyc: connecting to '{component}' on"
-            f" {target.rtb.parsed_url.hostname}:{rpyc_port}", dlevel = 3)
-        remote = rpyc.utils.classic.ssl_connect(
-            target.rtb.parsed_url.hostname,
-            port = rpyc_port)
+    # Reuse a connection we already opened to the same component in
+    # this same allocation if it is still alive; setting up a new
+    # one (specially with SSL) is way more expensive than checking.
+    if sync_timeout:
+        assert isinstance(sync_timeout, int) and sync_timeout > 0, \
+            f"sync_timeout: expected positive number of seconds; got {sync_timeout!r}"
+    allocid = target.testcase.allocid
+    connection_key = (
+        hostname, rpyc_port,
+        cert_name if ssl_enabled else None,
+        allocid,
+        sync_timeout
+    )
+    remote_old = _rpyc_connection_get(allocid, connection_key)
+    if remote_old != None and _rpyc_connection_alive(remote_old):
         target.report_info(
-            f"rpyc: connected to '{component}' on"
-            f" {target.rtb.parsed_url.hostname}:{rpyc_port}", dlevel = 2)
+            f"rpyc: reusing connection to '{component}' on"
+            f" {hostname}:{rpyc_port}", dlevel = 3)
+        return remote_old
 
+    remote = _rpyc_connect(rpyc, target, component, cert_name,
+                           rpyc_port, ssl_enabled)
     if sync_timeout:
-        assert isinstance(sync_timeout, int) and sync_timeout > 0, \
-            "sync_timeout: expected positive number of seconds; got {sync_timeout}"
+        # only on a connection nobody else has seen yet
         remote._config['sync_request_timeout'] = sync_timeout
-    return remote
+    return _rpyc_connection_put(connection_key, remote, remote_old)
+
+
+def rpyc_connect_many(target, components,
+                      cert_name: str = "default",
+                      iface_name = "power", sync_timeout = 60):
+    """Connect to multiple RPYC components exposed by the target
+
+    Same as :func:`rpyc_connect`, but connects to all the components
+    in parallel, so the network and SSL handshake latencies overlap.
+
+    >>> remotes = tcfl.tl.rpyc_connect_many(target, [ "c0", "c1" ])
+    >>> remotes['c0'].modules['os'].getpid()
+
+    :param list(str) components: names of the components that expose
+      the RPYC interface.
+
+    See :func:`rpyc_connect` for the rest of the parameters.
+
+    :returns dict: dictionary of connections keyed by component name
+    """
+    assert isinstance(components, collections.abc.Iterable) \
+        and not isinstance(components, str), \
+        "components: expected list of component names; got" \
+        f" {type(components).__name__}"
+    components = list(dict.fromkeys(components))
+    if not components:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(
+            min(len(components), 8)) as executor:
+        remotes = executor.map(
+            lambda component: rpyc_connect(
+                target, component, cert_name = cert_name,
+                iface_name = iface_name, sync_timeout = sync_timeout),
+            components)
+        return dict(zip(components, remotes))
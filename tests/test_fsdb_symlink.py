@@ -192,3 +192,71 @@ class _test(tcfl.tc.tc_c):
             else:
                 self.report_pass("get_as_dict(PATTERN1, PATTERN2) filters ok")
 
+
+
+    @tcfl.tc.subcase()
+    def eval_40_set_many(self):
+        fsdb_dir = os.path.join(self.tmpdir, "db-set-many")
+        commonl.makedirs_p(fsdb_dir)
+        fsdb = commonl.fsdb_symlink_c(fsdb_dir)
+
+        with self.subcase("set"):
+            d = {
+                "a": "string value",
+                "a.sub": 1,
+                "b": True,
+                "c": 3.0,
+            }
+            r = fsdb.set_many(d)
+            if r != True or fsdb.get_as_dict() != d:
+                raise tcfl.tc.failed_e(
+                    "set_many() didn't set all the values",
+                    dict(r = r, get_as_dict = fsdb.get_as_dict(), d = d))
+            self.report_pass("set_many() sets all the values")
+
+        with self.subcase("none-removes"):
+            # None removes the key and its subfields (a.sub)
+            r = fsdb.set_many({ "a": None, "b": None, "d": "new" })
+            d = fsdb.get_as_dict()
+            if r != True or d != { "c": 3.0, "d": "new" }:
+                raise tcfl.tc.failed_e(
+                    "set_many() with None values didn't remove them",
+                    dict(r = r, get_as_dict = d))
+            self.report_pass("set_many() with None values removes them")
+
+        with self.subcase("no-force"):
+            # existing keys are left alone and reported, new ones set
+            r = fsdb.set_many({ "c": 4.0, "e": "other" }, force = False)
+            d = fsdb.get_as_dict()
+            if r != False or d != { "c": 3.0, "d": "new", "e": "other" }:
+                raise tcfl.tc.failed_e(
+                    "set_many(force = False) didn't keep existing values",
+                    dict(r = r, get_as_dict = d))
+            r = fsdb.set_many({ "f": "more" }, force = False)
+            if r != True or fsdb.get("f") != "more":
+                raise tcfl.tc.failed_e(
+                    "set_many(force = False) didn't report new values set",
+                    dict(r = r, get_as_dict = fsdb.get_as_dict()))
+            self.report_pass("set_many(force = False) keeps existing values")
+
+
+    @tcfl.tc.subcase()
+    def eval_50_set_leftover_location(self):
+        # a process with our PID died before renaming its LOCATION-PID
+        # link into place; setting the key has to wipe it and go on
+        fsdb_dir = os.path.join(self.tmpdir, "db-leftover")
+        commonl.makedirs_p(fsdb_dir)
+        fsdb = commonl.fsdb_symlink_c(fsdb_dir)
+        location_pid = os.path.join(fsdb_dir, "key-" + str(os.getpid()))
+        os.symlink("s:stale value", location_pid)
+
+        fsdb.set("key", "value")
+        if fsdb.get("key") != "value":
+            raise tcfl.tc.failed_e(
+                "value not set over a leftover link",
+                dict(value = fsdb.get("key")))
+        l = os.listdir(fsdb_dir)
+        if l != [ "key" ]:
+            raise tcfl.tc.failed_e(
+                "leftover link not cleaned up", dict(listdir = l))
+        self.report_pass("set() wipes a leftover LOCATION-PID link")
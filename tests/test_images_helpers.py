@@ -0,0 +1,169 @@
+#! /usr/bin/python3
+#
+# Copyright (c) 2026 Intel Corporation
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# pylint: disable = missing-docstring
+
+import concurrent.futures
+import hashlib
+import os
+
+import commonl
+import tcfl.tc
+import ttbl.images
+import ttbl.store
+
+class _test(tcfl.tc.tc_c):
+    """
+    Exercise helpers in :mod:`ttbl.images` that need no server
+    """
+
+    @tcfl.tc.subcase()
+    def eval_00_paths_allowed_translate(self):
+        paths_allowed_orig = ttbl.store.paths_allowed
+        try:
+            ttbl.store.paths_allowed = {}
+            with self.subcase("empty"):
+                r = ttbl.images._paths_allowed_translate("/images/file")
+                if r != None:
+                    raise tcfl.tc.failed_e(
+                        f"nothing allowed, yet translated to {r}")
+                self.report_pass("nothing allowed, nothing translated")
+
+            ttbl.store.paths_allowed['/images'] = '/srv/images'
+            ttbl.store.paths_allowed['/images/big'] = '/srv/big'
+            ttbl.store.paths_allowed['/other.dir'] = '/srv/other'
+            for path, expected in [
+                    ( "/images/file", "/srv/images/file" ),
+                    # first match wins, as when scanning in order
+                    ( "/images/big/file", "/srv/images/big/file" ),
+                    # prefixes are matched as strings, not regexes
+                    ( "/otherxdir/file", None ),
+                    ( "/other.dir/file", "/srv/other/file" ),
+                    ( "/home/user/file", None ),
+            ]:
+                with self.subcase(path):
+                    r = ttbl.images._paths_allowed_translate(path)
+                    if r != expected:
+                        raise tcfl.tc.failed_e(
+                            f"{path}: translated to {r}, expected {expected}",
+                            dict(paths_allowed = ttbl.store.paths_allowed))
+                    self.report_pass(f"{path}: translated to {r}")
+
+            with self.subcase("added"):
+                # adding more entries has to be picked up
+                ttbl.store.paths_allowed['/home'] = '/srv/home'
+                r = ttbl.images._paths_allowed_translate("/home/user/file")
+                if r != "/srv/home/user/file":
+                    raise tcfl.tc.failed_e(
+                        f"new entry not picked up, translated to {r}",
+                        dict(paths_allowed = ttbl.store.paths_allowed))
+                self.report_pass("new entry picked up")
+
+            with self.subcase("same-length-different-keys"):
+                # swapping an entry for another keeps the length, but
+                # has to be picked up too
+                del ttbl.store.paths_allowed['/home']
+                ttbl.store.paths_allowed['/opt'] = '/srv/opt'
+                r_opt = ttbl.images._paths_allowed_translate("/opt/file")
+                r_home = ttbl.images._paths_allowed_translate("/home/file")
+                if r_opt != "/srv/opt/file" or r_home != None:
+                    raise tcfl.tc.failed_e(
+                        "swapped entry not picked up",
+                        dict(r_opt = r_opt, r_home = r_home,
+                             paths_allowed = ttbl.store.paths_allowed))
+                self.report_pass("swapped entry picked up")
+
+            with self.subcase("replaced"):
+                # so has replacing the whole dictionary
+                ttbl.store.paths_allowed = { '/new': '/srv/new' }
+                r = ttbl.images._paths_allowed_translate("/images/file")
+                r_new = ttbl.images._paths_allowed_translate("/new/file")
+                if r != None or r_new != "/srv/new/file":
+                    raise tcfl.tc.failed_e(
+                        "replaced dictionary not picked up",
+                        dict(r = r, r_new = r_new))
+                self.report_pass("replaced dictionary picked up")
+        finally:
+            ttbl.store.paths_allowed = paths_allowed_orig
+
+
+    @tcfl.tc.subcase()
+    def eval_10_hash_known(self):
+        class _target_c:
+            # _hash_record() / _hash_known() only need the fsdb
+            def __init__(self, fsdb_dir):
+                commonl.makedirs_p(fsdb_dir)
+                self.fsdb = commonl.fsdb_symlink_c(fsdb_dir)
+
+        target = _target_c(os.path.join(self.tmpdir, "db"))
+        images = ttbl.images.interface()
+        file_name = os.path.join(self.tmpdir, "image")
+        with open(file_name, "wb") as f:
+            f.write(b"image contents")
+
+        with self.subcase("hash"):
+            signature, hexdigest = ttbl.images._hash_file(file_name)
+            if signature != ttbl.images._file_signature(file_name) \
+               or hexdigest != hashlib.sha512(b"image contents").hexdigest():
+                raise tcfl.tc.failed_e(
+                    "_hash_file() doesn't return the signature and SHA512",
+                    dict(signature = signature, hexdigest = hexdigest))
+            self.report_pass("_hash_file() returns the signature and SHA512")
+
+        with self.subcase("unknown"):
+            r = images._hash_known(target, "kernel", file_name)
+            if r != None:
+                raise tcfl.tc.failed_e(f"nothing recorded, got hash {r}")
+            self.report_pass("nothing recorded, no hash known")
+
+        hashes = { file_name: concurrent.futures.Future() }
+        hashes[file_name].set_result(( signature, hexdigest ))
+        images._hash_record(target, { "kernel": file_name }, hashes)
+
+        with self.subcase("known"):
+            r = images._hash_known(target, "kernel", file_name)
+            if r != hexdigest:
+                raise tcfl.tc.failed_e(
+                    f"recorded hash not known, got {r}",
+                    dict(hexdigest = hexdigest))
+            self.report_pass("recorded hash is known")
+
+        with self.subcase("other-image-type"):
+            r = images._hash_known(target, "bios", file_name)
+            if r != None:
+                raise tcfl.tc.failed_e(
+                    f"hash recorded for another image type, got {r}")
+            self.report_pass("hash is known only for the image type flashed")
+
+        with self.subcase("modified"):
+            # same size, so only the mtime tells it changed
+            st = os.stat(file_name)
+            with open(file_name, "wb") as f:
+                f.write(b"IMAGE CONTENTS")
+            os.utime(file_name, ns = ( st.st_atime_ns, st.st_mtime_ns + 1 ))
+            r = images._hash_known(target, "kernel", file_name)
+            if r != None:
+                raise tcfl.tc.failed_e(
+                    f"file modified since recorded, yet got hash {r}")
+            self.report_pass("file modified since recorded, hash not known")
+
+        with self.subcase("replaced"):
+            # a new file with the same name, size and mtime is a
+            # different inode
+            hashes[file_name] = concurrent.futures.Future()
+            hashes[file_name].set_result(ttbl.images._hash_file(file_name))
+            images._hash_record(target, { "kernel": file_name }, hashes)
+            st = os.stat(file_name)
+            file_name_new = file_name + ".new"
+            with open(file_name_new, "wb") as f:
+                f.write(b"image contents")
+            os.utime(file_name_new, ns = ( st.st_atime_ns, st.st_mtime_ns ))
+            os.rename(file_name_new, file_name)
+            r = images._hash_known(target, "kernel", file_name)
+            if r != None:
+                raise tcfl.tc.failed_e(
+                    f"file replaced since recorded, yet got hash {r}")
+            self.report_pass("file replaced since recorded, hash not known")
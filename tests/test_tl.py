@@ -0,0 +1,156 @@
+#! /usr/bin/python3
+#
+# Copyright (c) 2026 Intel Corporation
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# pylint: disable = missing-docstring
+
+import subprocess
+
+import pyte
+
+import tcfl.tc
+import tcfl.tl
+
+class _test(tcfl.tc.tc_c):
+    """
+    Exercise helpers in :mod:`tcfl.tl` that need no targets
+    """
+
+    @tcfl.tc.subcase()
+    def eval_00_ansi_render_approx_plain(self):
+        # the fast path has to render the same as pyte would, or
+        # refuse to render
+        width = 80
+        height = 24
+        for name, s in [
+                ( "empty", "" ),
+                ( "single-line", "some text" ),
+                ( "crlf", "line 1\r\nline 2\r\n" ),
+                ( "empty-lines", "\r\n\r\n\r\nline 4\r\n\r\n\r\nline 7" ),
+                ( "trailing-spaces", "line 1   \r\n   line 2" ),
+                ( "full-width", "x" * width + "\r\n" + "y" * width ),
+                ( "full-height", "\r\n".join([ "z" ] * height) ),
+        ]:
+            with self.subcase(name):
+                r = tcfl.tl._ansi_render_approx_plain(s, width, height)
+                screen = pyte.Screen(width, height)
+                pyte.Stream(screen).feed(s)
+                expected = tcfl.tl._ansi_render_lines(screen.display)
+                if r != expected:
+                    raise tcfl.tc.failed_e(
+                        "plain render doesn't match pyte's",
+                        dict(s = s, r = r, expected = expected))
+                self.report_pass("plain render matches pyte's")
+
+        for name, s in [
+                ( "escape", "\x1b[2Jtext" ),
+                ( "csi", "\x9b2Jtext" ),
+                ( "non-ascii", "ñ" ),
+                ( "backspace", "ab\bc" ),
+                ( "tab", "a\tb" ),
+                ( "lone-lf", "line 1\nline 2" ),
+                ( "lone-cr", "line 1\rline 2" ),
+                ( "wraps", "x" * (width + 1) ),
+                ( "scrolls", "\r\n".join([ "z" ] * (height + 1)) ),
+        ]:
+            with self.subcase(name):
+                r = tcfl.tl._ansi_render_approx_plain(s, width, height)
+                if r != None:
+                    raise tcfl.tc.failed_e(
+                        "plain render didn't defer to pyte",
+                        dict(s = s, r = r))
+                self.report_pass("plain render defers to pyte")
+
+
+    ifstat = """\
+iPXE> ifstat
+net0: 52:54:00:12:34:56 using 82540em on 0000:00:03.0 (Ethernet) [open]
+  [Link:up, TX:0 TXE:0 RX:0 RXE:0]
+bogus: 52:54:00:12:34:99 using 82540em on 0000:00:04.0 (Ethernet) [closed]
+net1: 52:54:00:12:34:5 using 82540em on 0000:00:05.0 (Ethernet) [closed]
+  [Link:down, TX:0 TXE:0 RX:0 RXE:0]
+net12: 52:54:00:12:34:99 using 82540em on 0000:00:06.0 (Ethernet) [closed]
+  [Link:down, TX:0 TXE:0 RX:0 RXE:0]
+"""
+
+    @tcfl.tc.subcase()
+    def eval_10_ipxe_ifname_find(self):
+        for mac_addr, expected in [
+                # first interface
+                ( "52:54:00:12:34:56", "net0" ),
+                # a prefix of net0's MAC address
+                ( "52:54:00:12:34:5", "net1" ),
+                # first shows in a line that is not a netN interface
+                ( "52:54:00:12:34:99", "net12" ),
+                ( "52:54:00:12:34:00", None ),
+        ]:
+            with self.subcase(mac_addr):
+                ifname = tcfl.tl._ipxe_ifname_find(self.ifstat, mac_addr)
+                if ifname != expected:
+                    raise tcfl.tc.failed_e(
+                        f"{mac_addr}: found interface {ifname},"
+                        f" expected {expected}",
+                        dict(ifstat = self.ifstat))
+                self.report_pass(f"{mac_addr}: found interface {ifname}")
+
+
+    @tcfl.tc.subcase()
+    def eval_20_tap_parse_output(self):
+        # lines after the TAP version header used to fail parsing
+        output = """\
+TAP version 13
+1..4
+ok 1 - first
+# some output
+# more output
+not ok 2 - second
+ok 3 - third # SKIP not supported
+ok 4 - fourth # TODO later
+"""
+        tcs = tcfl.tl.tap_parse_output(output.splitlines())
+        expected = {
+            "first": ( "ok", "", " some output\n more output\n", [ 3, 4, 5 ] ),
+            "second": ( "not ok", "", "", [ 6 ] ),
+            "third": ( "skip", "SKIP not supported", "", [ 7 ] ),
+            "fourth": ( "todo", "TODO later", "", [ 8 ] ),
+        }
+        if set(tcs) != set(expected):
+            raise tcfl.tc.failed_e(
+                "parsed testcases don't match expected",
+                dict(tcs = tcs, expected = expected))
+        for subject, ( result, directive, output, lines ) \
+            in expected.items():
+            with self.subcase(subject):
+                tc = tcs[subject]
+                if tc['result'] != result \
+                   or tc['directive'] != directive \
+                   or tc['output'] != output \
+                   or tc['lines'] != lines:
+                    raise tcfl.tc.failed_e(
+                        f"{subject}: parsed data doesn't match expected",
+                        dict(tc = tc, result = result, directive = directive,
+                             output = output, lines = lines))
+                self.report_pass(f"{subject}: parsed as {result}")
+
+
+    @tcfl.tc.subcase()
+    def eval_30_sh_cmd_args(self):
+        # whichever way the arguments are passed, the shell has to run
+        # the command with all of them, in order
+        for count in [ 1, 20, 21, 100 ]:
+            with self.subcase(f"{count}-args"):
+                args = [ f"package-{i}" for i in range(count) ]
+                cmd, heredoc = tcfl.tl._sh_cmd_args("printf '%s\\n'", args)
+                if (count <= 20) != (heredoc == ""):
+                    raise tcfl.tc.failed_e(
+                        f"{count} arguments: unexpected here document use",
+                        dict(cmd = cmd, heredoc = heredoc))
+                output = subprocess.check_output(
+                    [ "/bin/sh", "-c", cmd + heredoc ], text = True)
+                if output.splitlines() != args:
+                    raise tcfl.tc.failed_e(
+                        f"{count} arguments: command didn't get them all",
+                        dict(cmd = cmd, heredoc = heredoc, output = output))
+                self.report_pass(f"{count} arguments: command gets them all")
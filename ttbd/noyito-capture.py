@@ -70,7 +70,8 @@ import ttbl.capture_cli
 # Main
 #
 line_regex = re.compile(
-    r"^CH(?P<channel>[0-9]+):(?P<sample>[0-9]+)\t(?P<voltage>[\.0-9]+)V$")
+    r"^[ \t\r]*CH(?P<channel>[0-9]+):(?P<sample>[0-9]+)\t(?P<voltage>[\.0-9]+)V[ \t\r]*$",
+    re.MULTILINE)
 unix_domain_socket = sys.argv[1]
 outputfilename = sys.argv[2]
 modes = {}
@@ -112,12 +113,10 @@ def parse_chunk(chunk):
     voltages = {}
     # make it all a string, easier
     chunk = chunk.decode('ascii')
-    for line in chunk.splitlines():
+    # scan the whole chunk in one go, lines that don't match are
+    # skipped (hmmm FIXME?)
+    for match in line_regex.finditer(chunk):
         ## CH<CH>:<NNNN><TAB><FLOAT>V\r\n
-        match = line_regex.match(line.strip())
-        if not match:
-            # hmmm FIXME?
-            continue
         gd = match.groupdict()
         channel = gd['channel']
         samples[channel] = gd['sample']
@@ -2334,6 +2334,32 @@ def _sysfs_read(filename):
         if e.errno != errno.ENOENT:
             raise
 
+#: Cache of USB serial number to sysfs device path
+#:
+#: Filled up by :func:`_usb_serial_devpath`; entries are verified on
+#: use, as devices move around when replugged.
+_usb_serial_devpaths = {}
+
+def _usb_serial_devpath(arg_serial):
+    # Return the sysfs path of the device with the given USB serial
+    # number (or None)
+    #
+    # Finding it means reading the serial number of every USB device
+    # in the system, so remember where we found it and just check it
+    # is still there next time
+    devpath = _usb_serial_devpaths.get(arg_serial, None)
+    if devpath \
+       and _sysfs_read(os.path.join(devpath, "serial")) == arg_serial:
+        return devpath
+    _usb_serial_devpaths.pop(arg_serial, None)
+    for fn_serial in glob.glob("/sys/bus/usb/devices/*/serial"):
+        devpath = os.path.dirname(fn_serial)
+        if _sysfs_read(fn_serial) == arg_serial:
+            _usb_serial_devpaths[arg_serial] = devpath
+            return devpath
+    return None
+
+
 def usb_serial_to_path(arg_serial, sibling_port = None):
     """
     Given a USB serial number, return it's USB path
@@ -2366,20 +2392,18 @@ def usb_serial_to_path(arg_serial, sibling_port = None):
             if e.errno != errno.ENOENT:
                 raise
 
-    for fn_serial in glob.glob("/sys/bus/usb/devices/*/serial"):
-        serial = _sysfs_read(fn_serial)
-        if serial == arg_serial:
-            devpath = os.path.dirname(fn_serial)
-            if sibling_port != None:
-                if '.' in devpath:
-                    separator = "."
-                else:
-                    separator = "-"
-                head, _sep, _tail = devpath.rpartition(separator)
-                devpath = head + separator + str(sibling_port)
-            return os.path.basename(devpath), \
-                _sysfs_read(os.path.join(devpath, "vendor")), \
-                _sysfs_read(os.path.join(devpath, "product"))
+    devpath = _usb_serial_devpath(arg_serial)
+    if devpath:
+        if sibling_port != None:
+            if '.' in devpath:
+                separator = "."
+            else:
+                separator = "-"
+            head, _sep, _tail = devpath.rpartition(separator)
+            devpath = head + separator + str(sibling_port)
+        return os.path.basename(devpath), \
+            _sysfs_read(os.path.join(devpath, "vendor")), \
+            _sysfs_read(os.path.join(devpath, "product"))
     return None, None, None
 
 
@@ -2444,25 +2468,22 @@ def usb_device_by_serial(arg_serial, sibling_port = None, *fields):
     #
     ## $ grep -r YK18738 /sys/bus/usb/devices/*/serial
     ## /sys/bus/usb/devices/1-3.4.3.4/serial:YK18738
-    for fn_serial in glob.glob("/sys/bus/usb/devices/*/serial"):
-        serial = _sysfs_read(fn_serial)
-        if serial == arg_serial:
-            devpath = os.path.dirname(fn_serial)
-            if sibling_port != None:
-                # We are looking for a sibling, so let's find it and
-                # modify devpath to point to it.
-                # Replace the last .4 in the directory name by our
-                # port number in the arguments and look at that
-                # top level devices are BUSNUM-PORTNUMBER, vs after they
-                # are BUSNUM-PORTNUMBER.[PORTNUMBER[.PORTNUMBER...]]
-                if '.' in devpath:
-                    separator = "."
-                else:
-                    separator = "-"
-                head, _sep, _tail = devpath.rpartition(separator)
-                devpath = head + separator + str(sibling_port)
-            if not os.path.isdir(devpath):
-                break
+    devpath = _usb_serial_devpath(arg_serial)
+    if devpath:
+        if sibling_port != None:
+            # We are looking for a sibling, so let's find it and
+            # modify devpath to point to it.
+            # Replace the last .4 in the directory name by our
+            # port number in the arguments and look at that
+            # top level devices are BUSNUM-PORTNUMBER, vs after they
+            # are BUSNUM-PORTNUMBER.[PORTNUMBER[.PORTNUMBER...]]
+            if '.' in devpath:
+                separator = "."
+            else:
+                separator = "-"
+            head, _sep, _tail = devpath.rpartition(separator)
+            devpath = head + separator + str(sibling_port)
+        if os.path.isdir(devpath):
             if not fields:
                 return devpath
             return [ devpath ] + [
@@ -120,12 +120,44 @@ import commonl
 import ttbl
 
 class interface(ttbl.tt_interface):
-
-    def __init__(self, key_size = 2048):
+    """
+    :param int key_size: (optional, default 2048) size in bits of
+      the keys when *key_type* is *rsa*.
+
+    :param str key_type: (optional) type of keys to generate:
+
+      - *ec*: elliptic curve NIST P-256 keys; these are way cheaper
+        to generate and to do SSL handshakes with than RSA keys
+
+      - *rsa*: RSA keys of *key_size* bits
+
+      Defaults to *ec*, unless *key_size* is given, then *rsa*, as
+      that was the only type of key generated before.
+    """
+    def __init__(self, key_size = None, key_type = None):
+        assert key_size == None or isinstance(key_size, int) and key_size > 0
+        assert key_type in ( None, "ec", "rsa" ), \
+            f"key_type: expected 'ec' or 'rsa'; got {key_type}"
+        if key_type == None:
+            key_type = "ec" if key_size == None else "rsa"
+        if key_size == None:
+            key_size = 2048
         ttbl.tt_interface.__init__(self)
+        self.key_type = key_type
         self.key_size = key_size
 
 
+    def _key_create(self, key_path, cwd):
+        if self.key_type == "ec":
+            algorithm = "-algorithm EC -pkeyopt ec_paramgen_curve:P-256"
+        else:
+            algorithm = f"-algorithm RSA -pkeyopt rsa_keygen_bits:{self.key_size}"
+        subprocess.run(
+            f"openssl genpkey {algorithm} -out {key_path}".split(),
+            stdin = None, timeout = 5,
+            capture_output = True, cwd = cwd, check = True)
+
+
     def _setup_maybe(self, target, cert_path, cert_client_path):
         if os.path.isdir(cert_path) and os.path.isdir(cert_client_path):
             return
@@ -142,9 +174,9 @@ class interface(ttbl.tt_interface):
             # be killed when the target is released
 
             allocid = target.fsdb.get("_alloc.id", "UNKNOWN")
+            self._key_create("ca.key", cert_path)
             subprocess.run(
-                f"openssl req -nodes -newkey rsa:{self.key_size}"
-                f" -keyform PEM -keyout ca.key"
+                f"openssl req -new -key ca.key"
                 f" -subj /C=LC/ST=Local/L=Local/O=TCF-Signing-Authority-{target.id}-{allocid}/CN=TTBD"
                 f" -x509 -days 1000 -outform PEM -out ca.cert".split(),
                 check = True, cwd = cert_path,
@@ -152,10 +184,7 @@ class interface(ttbl.tt_interface):
             target.log.debug(f"created target's certificate authority in {cert_path}")
 
             # Now create a server key
-            subprocess.run(
-                f"openssl genrsa -out server.key {self.key_size}".split(),
-                stdin = None, timeout = 5,
-                capture_output = True, cwd = cert_path, check = True)
+            self._key_create("server.key", cert_path)
             target.log.debug("created target's server key")
 
             subprocess.run(
@@ -253,10 +282,7 @@ class interface(ttbl.tt_interface):
                     })
 
             try:
-                subprocess.run(
-                    f"openssl genrsa -out {client_key_path} {self.key_size}".split(),
-                    stdin = None, timeout = 5,
-                    capture_output = True, cwd = cert_path, check = True)
+                self._key_create(client_key_path, cert_path)
                 allocid = target.fsdb.get("_alloc.id", "UNKNOWN")
                 subprocess.run(
                     f"openssl req -new -key {client_key_path} -out {client_req_path}"
@@ -104,6 +104,12 @@ There is the posibility of executing :meth:`power control sequences
   *False*) can execute pre and post sequences before each executes and
   flashes the images assigned to it.
 
+  Consecutive serial implementations that declare
+  *power_sequence_shareable* (see :class:`impl_c`) and have the same
+  pre and post sequences share a single run of them: the pre sequence
+  is run, all of them flash, one after another, and then the post
+  sequence is run.
+
   In the example above, *implB* can have its on pre/post sequnece that
   it'll be run before and after flashing *fileB* in *imageB*. As well,
   *implGH* can have it's sequences that will be run befora and after
@@ -202,19 +208,22 @@ flashers::
 
 """
 
-import codecs
-import collections
-import copy
+import concurrent.futures
 import errno
 import hashlib
-import json
+import heapq
+import logging
 import numbers
 import os
+import re
+import select
+import signal
+import socket
 import subprocess
+import tempfile
+import termios
 import time
 
-import serial
-
 import commonl
 import ttbl
 import ttbl.store
@@ -245,6 +254,13 @@ class impl_c(ttbl.tt_interface_impl_c):
 
     :param list(str) power_sequence_post: (optional) FIXME
 
+    :param bool power_sequence_shareable: (optional; default *False*)
+      when flashing serially, this flasher can share the pre and
+      post power sequences with the flasher run right before it, if
+      that one is also shareable and both sequences are the
+      same--this saves a power cycle. Flashers that need the reset
+      the pre power sequence does each time shall leave it *False*.
+
     :param list(str) console_disable: (optional) before flashing,
       disable consoles and then re-enable them. Argument is a list of
       console names that need disabling and then re-enabling.
@@ -260,13 +276,19 @@ class impl_c(ttbl.tt_interface_impl_c):
       this is useful for drivers that are used for multiple images,
       where it is not clear which one will it be called to flash to.
     """
+    # No __slots__ here or in the drivers: configuration overrides
+    # class-level settings (eg: *path*) on the instances, and there is
+    # one instance per flasher, not per flash, so the per-instance
+    # dictionaries don't add up to anything worth saving.
     def __init__(self,
                  power_sequence_pre = None,
                  power_sequence_post = None,
                  consoles_disable = None,
                  log_name = None,
-                 estimated_duration = 60):
+                 estimated_duration = 60,
+                 power_sequence_shareable = False):
         assert isinstance(estimated_duration, int)
+        assert isinstance(power_sequence_shareable, bool)
         assert log_name == None or isinstance(log_name, str)
 
         commonl.assert_none_or_list_of_strings(
@@ -275,6 +297,7 @@ class impl_c(ttbl.tt_interface_impl_c):
         # validation of this one by ttbl.images.interface._target_setup
         self.power_sequence_pre = power_sequence_pre
         self.power_sequence_post = power_sequence_post
+        self.power_sequence_shareable = power_sequence_shareable
         if consoles_disable == None:
             consoles_disable = []
         self.parallel = False	# this class can't do parallel
@@ -375,6 +398,13 @@ class impl2_c(impl_c):
     :param int retries (optional; defaults to 3) how many times to
       retry before giving up, on failure.
 
+    :param bool flash_start_concurrent: (optional; defaults to
+      *False*) when run in parallel with other flashers that also set
+      it, :meth:flash_start might be called concurrently from
+      different threads; only enable if :meth:flash_start is
+      thread safe and benefits from it (eg: it blocks configuring a
+      cable before starting the flasher).
+
       Note you can/should overload :meth:`flast_post_check` so that on
       failure (if it returns anything but *None*) you might perform a
       recovery action.
@@ -387,7 +417,8 @@ class impl2_c(impl_c):
                allow future expansion)
 
     """
-    def __init__(self, check_period = 2, parallel = False, retries = 3, **kwargs):
+    def __init__(self, check_period = 2, parallel = False, retries = 3,
+                 flash_start_concurrent = False, **kwargs):
         assert isinstance(check_period, numbers.Real) and check_period > 0.5, \
             "check_period must be a positive number of seconds " \
             "greater than 0.5; got %s" % type(check_period)
@@ -395,8 +426,12 @@ class impl2_c(impl_c):
             "parallel must be a bool; got %s" % type(parallel)
         assert isinstance(retries, int) and retries >= 0, \
             "retries must be >= 0; got %s" % type(retries)
+        assert isinstance(flash_start_concurrent, bool), \
+            "flash_start_concurrent must be a bool; got %s" \
+            % type(flash_start_concurrent)
         self.check_period = check_period
         self.retries = retries
+        self.flash_start_concurrent = flash_start_concurrent
         impl_c.__init__(self, **kwargs)
         # otherwise it is overriden
         self.parallel = parallel
@@ -421,6 +456,9 @@ class impl2_c(impl_c):
 
         Do not use Python threads or multiprocessing, just fork().
 
+        Flashers run in parallel are started one after another, unless
+        they set *flash_start_concurrent*.
+
         """
         raise NotImplementedError
 
@@ -463,6 +501,47 @@ class impl2_c(impl_c):
         return {}	# diagnostics info
 
 
+# (ttbl.store.paths_allowed keys, regex matching any of them)
+#
+# paths_allowed is normally set once by the configuration, so we
+# recompile only when its keys change (in any way, including their
+# order, since the first match wins)
+_paths_allowed_regex = ( None, None )
+
+def _paths_allowed_translate(path):
+    # translate a path if it starts with any of the prefixes in
+    # ttbl.store.paths_allowed (first match wins, as when
+    # scanning them in order); None if it is not allowed
+    global _paths_allowed_regex
+    paths_allowed = ttbl.store.paths_allowed
+    if not paths_allowed:
+        return None
+    prefixes = tuple(paths_allowed)
+    prefixes_cached, regex = _paths_allowed_regex
+    if prefixes != prefixes_cached:
+        regex = re.compile("|".join(re.escape(prefix)
+                                    for prefix in prefixes))
+        _paths_allowed_regex = ( prefixes, regex )
+    m = regex.match(path)
+    if m == None:
+        return None
+    return paths_allowed[m.group(0)] + path[m.end():]
+
+
+def _file_signature(file_name):
+    # if none of these changed, we assume the file's contents didn't
+    # either
+    st = os.stat(file_name)
+    return "%d:%d:%d:%d" % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _hash_file(file_name):
+    # take the signature before reading, so if the file is modified
+    # while we hash it, it won't match next time
+    signature = _file_signature(file_name)
+    return signature, commonl.hash_file(hashlib.sha512(), file_name).hexdigest()
+
+
 class interface(ttbl.tt_interface):
     """Interface to flash a list of images (OS, BIOS, Firmware...) that
     can be uploaded to the target server and flashed onto a target.
@@ -531,7 +610,7 @@ class interface(ttbl.tt_interface):
     def _release_hook(self, target, _force):
         pass
 
-    def _hash_record(self, target, images):
+    def _hash_record(self, target, images, hashes):
         # if update MD5s of the images we flashed (if succesful)
         # so we can use this to select where we want to run
         #
@@ -539,90 +618,189 @@ class interface(ttbl.tt_interface):
         # sometimes; the name can change though, but the content stays
         # the same, hence the hash is the first reference one.
         #
+        # The hashes were started in the background by put_flash()
+        # when the images were decompressed, so they overlap with the
+        # flashing instead of re-reading the files after it.
+        #
         # note this gives the same result as:
         #
         ## $ sha512sum FILENAME
         #
+        # Keep it SHA512: clients compare it against the SHA512 they
+        # compute locally or get from the store interface to decide
+        # if they need to flash at all (soft flashing, see
+        # tcfl.target_ext_images), so another algorithm would need a
+        # new key and both sides computing it.
+        #
+        # The file's signature (see _file_signature()) is recorded too,
+        # so if the same file is flashed again, _hash_known() can tell
+        # the hash without reading it again.
+        d = {}
         for image_type, name in list(images.items()):
-            ho = commonl.hash_file(hashlib.sha512(), name)
-            target.fsdb.set(
-                "interfaces.images." + image_type + ".last_sha512",
-                ho.hexdigest()
-            )
-            target.fsdb.set(
-                "interfaces.images." + image_type + ".last_name",
-                name
-            )
-
-    def _flash_parallel_do(self, target, parallel, image_names):
+            signature, hexdigest = hashes[name].result()
+            d["interfaces.images." + image_type + ".last_sha512"] = hexdigest
+            d["interfaces.images." + image_type + ".last_name"] = name
+            d["interfaces.images." + image_type + ".last_signature"] = signature
+        target.fsdb.set_many(d)
+
+    def _hash_known(self, target, image_type, file_name):
+        # if this is the same file last flashed in this image type and
+        # it has not changed since (see _hash_record()), return the
+        # hash we recorded then; this is common when re-flashing the
+        # same image over and over
+        prefix = "interfaces.images." + image_type
+        if target.fsdb.get(prefix + ".last_name") != file_name:
+            return None
+        if target.fsdb.get(prefix + ".last_signature") \
+           != _file_signature(file_name):
+            return None
+        return target.fsdb.get(prefix + ".last_sha512")
+
+    def _flash_start(self, target, parallel, image_names, contexts):
+        # flash_start() can block for a while (eg: configuring the
+        # cable before launching the flasher); flashers are told not
+        # to rely on Python threads, so they are started one after
+        # another, unless they declare *flash_start_concurrent*--then
+        # those are all started at the same time.
+        concurrent_impls = [
+            impl for impl in parallel if impl.flash_start_concurrent ]
+        if len(concurrent_impls) < 2:
+            concurrent_impls = []
+        failed = {}
+        started = []
+        for impl, images in parallel.items():
+            if impl in concurrent_impls:
+                continue
+            try:
+                impl.flash_start(target, images, contexts[impl])
+                started.append(impl)
+            except Exception as e:
+                failed[impl] = e
+                break
+        if concurrent_impls and not failed:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers = len(concurrent_impls)) as executor:
+                futures = {
+                    impl: executor.submit(impl.flash_start, target,
+                                          parallel[impl], contexts[impl])
+                    for impl in concurrent_impls
+                }
+            # the executor has waited for all of them to be done
+            for impl, future in futures.items():
+                if future.exception() != None:
+                    failed[impl] = future.exception()
+                else:
+                    started.append(impl)
+        if not failed:
+            return
+        msg = "%s/%s: flashing failed to start: %s" % (
+            target.id, " ".join(image_names[impl] for impl in failed),
+            " ".join(str(e) for e in failed.values()))
+        target.log.error(msg)
+        for impl in started:
+            impl.flash_kill(target, parallel[impl], contexts[impl], msg)
+        raise RuntimeError(msg)
+
+    def _flash_parallel_do(self, target, parallel, image_names, hashes):
         # flash a parallel-capable flasher in a serial fashion; when
         # something fails, repeat it right away if it has retries
         contexts = {}
         estimated_duration = 0
-        check_period = 4
-        all_images = [ ]
-        for impl, images in list(parallel.items()):
+        for impl, images in parallel.items():
             context = dict()
             context['ts0'] = time.time()
             context['retry_count'] = 1	# 1 based, nicer for human display
             contexts[impl] = context
             estimated_duration = max(impl.estimated_duration, estimated_duration)
-            check_period = min(impl.check_period, check_period)
-            all_images += images.keys()
             target.log.info("%s: flashing %s", target.id, image_names[impl])
-            impl.flash_start(target, images, context)
+        self._flash_start(target, parallel, image_names, contexts)
 
-        ts = ts0 = time.time()
-        done = set()
+        # each flasher is checked at its own check period; keep them
+        # in a heap sorted by when they are due next so we sleep until
+        # the next one is due. Completed flashers are not scheduled
+        # again. The index is there so impls never get compared.
+        #
+        # Use the monotonic clock, so wall clock adjustments (eg: NTP)
+        # don't make us time out too soon or too late; context['ts0']
+        # stays wall clock, as documented for the drivers.
+        ts0 = time.monotonic()
+        schedule = [
+            ( ts0 + impl.check_period, index, impl )
+            for index, impl in enumerate(parallel)
+        ]
+        heapq.heapify(schedule)
+        deadline = ts0 + estimated_duration
         done_impls = set()
-        while ts - ts0 < estimated_duration:
+        while schedule:
+            ts_next, index, impl = heapq.heappop(schedule)
             target.timestamp()	# timestamp so we don't idle...
-            time.sleep(check_period)
-            for impl, images in parallel.items():
-                if impl in done_impls:	# already completed? skip
+            time.sleep(max(0, min(ts_next, deadline) - time.monotonic()))
+            images = parallel[impl]
+            context = contexts[impl]
+            retry_count = context['retry_count']
+            if impl.flash_check_done(target, images, context) == True:
+                # says it is done, let's verify it
+                r = impl.flash_post_check(target, images, context)
+                if r == None:
+                    # success! we are done in this one
+                    self._hash_record(target, images, hashes)
+                    done_impls.add(impl)
+                    target.log.warning(
+                        "%s/%s: flashing completed; done_impls: %s",
+                        target.id, image_names[impl], done_impls)
                     continue
-                context = contexts[impl]
-                retry_count = context['retry_count']
-                ts = time.time()
-                if ts - ts0 > impl.check_period \
-                   and impl.flash_check_done(target, images, context) == True:
-                    # says it is done, let's verify it
-                    r = impl.flash_post_check(target, images, context)
-                    if r == None:
-	                # success! we are done in this one
-                        self._hash_record(target, images)
-                        done.update(images.keys())
-                        done_impls.add(impl)
-                        target.log.warning(
-                            "%s/%s: flashing completed; done_impls: %s",
-                            target.id, image_names[impl], done_impls)
-                    elif retry_count <= impl.retries:
-	                # failed, retry?
-                        context['retry_count'] += 1
-                        target.log.warning(
-                            "%s/%s: flashing failed, retrying %d/%d: %s",
-                            target.id, image_names[impl],
-                            context['retry_count'], impl.retries, r)
-                        impl.flash_start(target, images, context)
-                    else:
-                        # failed, out of retries, error as soon as possible
-                        msg = "%s/%s: flashing failed %d times, aborting: %s" % (
-                            target.id, image_names[impl], retry_count, r)
-                        target.log.error(msg)
-                        for _impl, _images in parallel.items():
-                            _impl.flash_kill(target, _images, contexts[_impl], msg)
-                        raise RuntimeError(msg)
-            ts = time.time()
-            if len(done_impls) == len(parallel):
-                target.log.info("flashed images" + " ".join(image_names.values()))
-                return
-        else:
-            msg = "%s/%s: flashing failed: timedout after %ds" \
-                % (target.id, " ".join(all_images), estimated_duration)
-            for impl, images in list(parallel.items()):
-                impl.flash_kill(target, images, contexts[impl], msg)
-            raise RuntimeError(msg)
-
+                if retry_count <= impl.retries:
+                    # failed, retry?
+                    context['retry_count'] += 1
+                    target.log.warning(
+                        "%s/%s: flashing failed, retrying %d/%d: %s",
+                        target.id, image_names[impl],
+                        context['retry_count'], impl.retries, r)
+                    impl.flash_start(target, images, context)
+                else:
+                    # failed, out of retries, error as soon as possible
+                    msg = "%s/%s: flashing failed %d times, aborting: %s" % (
+                        target.id, image_names[impl], retry_count, r)
+                    target.log.error(msg)
+                    for _impl, _images in parallel.items():
+                        _impl.flash_kill(target, _images, contexts[_impl], msg)
+                    raise RuntimeError(msg)
+            if time.monotonic() >= deadline:
+                msg = "%s/%s: flashing failed: timedout after %ds" \
+                    % (target.id,
+                       " ".join(image_type
+                                for images in parallel.values()
+                                for image_type in images),
+                       estimated_duration)
+                for impl, images in parallel.items():
+                    impl.flash_kill(target, images, contexts[impl], msg)
+                raise RuntimeError(msg)
+            heapq.heappush(schedule,
+                           ( time.monotonic() + impl.check_period, index, impl ))
+        target.log.info("flashed images" + " ".join(image_names.values()))
+
+
+    def _flash_consoles_put(self, target, put_method, console_names):
+        # consoles are independent of each other and enabling or
+        # disabling them might block for a while, so when there are
+        # many, do them in parallel; raise the first error after all
+        # are done. Multiple flashers might list the same console, so
+        # do each only once.
+        console_names = list(dict.fromkeys(console_names))
+        if len(console_names) < 2:
+            for console_name in console_names:
+                put_method(target, ttbl.who_daemon(),
+                           dict(component = console_name), None, None)
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers = len(console_names)) as executor:
+            futures = [
+                executor.submit(put_method, target, ttbl.who_daemon(),
+                                dict(component = console_name), None, None)
+                for console_name in console_names
+            ]
+        for future in futures:
+            future.result()
 
     def _flash_consoles_disable(self, target, parallel, image_names):
         # in some flashers, the flashing occurs over a
@@ -631,46 +809,53 @@ class interface(ttbl.tt_interface):
         # This has to be done after the power-cycle, as it might
         # be enabling consoles
         # FIXME: move this for parallel too?
+        console_names = []
         for impl in parallel:
             for console_name in impl.consoles_disable:
                 target.log.info(
                     "flasher %s/%s: disabling console %s to allow flasher to work",
                     target.id, image_names[impl], console_name)
-                target.console.put_disable(
-                    target, ttbl.who_daemon(),
-                    dict(component = console_name),
-                    None, None)
+                console_names.append(console_name)
+        self._flash_consoles_put(target, target.console.put_disable,
+                                 console_names)
 
     def _flash_consoles_enable(self, target, parallel, image_names):
+        console_names = []
         for impl in parallel:
             for console_name in impl.consoles_disable:
                 target.log.info(
                     "flasher %s/%s: enabling console %s after flashing",
                     target.id, image_names[impl], console_name)
-                target.console.put_enable(
-                    target, ttbl.who_daemon(),
-                    dict(component = console_name),
-                    None, None)
+                console_names.append(console_name)
+        self._flash_consoles_put(target, target.console.put_enable,
+                                 console_names)
 
 
-    def _flash_parallel(self, target, parallel, power_sequence_pre, power_sequence_post):
+    def _flash_parallel(self, target, parallels, power_sequence_pre,
+                        power_sequence_post, hashes):
+        # flash each {IMPL: IMAGES} dictionary in parallels one after
+        # another, all sharing a single run of the power sequences
         if power_sequence_pre:
             target.power.sequence(target, power_sequence_pre)
 
-        image_names = { }
-        for impl, images in parallel.items():
-            image_names[impl] = ",".join([ i + ":" + images[i] for i in images ])
-
         try:
-            target.log.info("flasher %s/%s: starting",
-                            target.id, image_names[impl])
-            self._flash_consoles_disable(target, parallel, image_names)
-            self._flash_parallel_do(target, parallel, image_names)
-        finally:
-            target.log.info("flasher %s/%s: done",
-                            target.id, image_names[impl])
-            self._flash_consoles_enable(target, parallel, image_names)
+            for parallel in parallels:
+                image_names = { }
+                for impl, images in parallel.items():
+                    image_names[impl] = ",".join(
+                        image_type + ":" + name
+                        for image_type, name in images.items())
 
+                try:
+                    target.log.info("flasher %s/%s: starting",
+                                    target.id, image_names[impl])
+                    self._flash_consoles_disable(target, parallel, image_names)
+                    self._flash_parallel_do(target, parallel, image_names, hashes)
+                finally:
+                    target.log.info("flasher %s/%s: done",
+                                    target.id, image_names[impl])
+                    self._flash_consoles_enable(target, parallel, image_names)
+        finally:
             # note the post sequence is not run in case of flashing error,
             # this is intended, things might be a in a weird state, so a
             # full power cycle might be needed
@@ -678,6 +863,25 @@ class interface(ttbl.tt_interface):
                 target.power.sequence(target, power_sequence_post)
 
 
+    def _decompress(self, target, file_name):
+        # we need to lock, since other processes might be
+        # trying to decompress the file at the same time
+        # We want to have the lock in another directory
+        # because the source directory where the file name
+        # might be might not be writable to us
+        lock_file_name = os.path.join(
+            target.state_dir,
+            "images.flash.decompress."
+            + commonl.mkid(file_name)
+            + ".lock")
+        with ttbl.process_posix_file_lock_c(lock_file_name):
+            # if a decompressor crashed, we have no way to
+            # tell if the decompressed file is correct or
+            # truncated and thus corrupted -- we need manual
+            # for that
+            return commonl.maybe_decompress(file_name)
+
+
     def put_flash(self, target, who, args, _files, user_path):
         images = self.arg_get(args, 'images', dict)
         with target.target_owned_and_locked(who):
@@ -687,7 +891,7 @@ class interface(ttbl.tt_interface):
             #
             # We'll give a single call to each implementation with all
             # the images it has to flash in the same order they are
-            # given to us (hence the OrderedDict)
+            # given to us (dicts keep insertion order)
             #
             # Note we DO resolve aliases here (imagetype whole
             # implementation is a string naming another
@@ -696,11 +900,7 @@ class interface(ttbl.tt_interface):
             # NAME:FILEB*, then FILEB will be flashed and FILEA
             # ignored; if they do *NAME:FILEB NAME-AKA:FILEA*, FILEA
             # will be flashed.
-            #
-            # flashers that work serially bucketed separated from the
-            # ones that can do parallel
-            serial = collections.defaultdict(collections.OrderedDict)
-            parallel = collections.defaultdict(collections.OrderedDict)
+            file_names = []
             for img_type, img_name in images.items():
                 # validate image types (from the keys) are valid from
                 # the components and aliases
@@ -712,55 +912,121 @@ class interface(ttbl.tt_interface):
                 else:
                     # file from the system (mounted FS or similar);
                     # double check it is allowed
-                    for path, path_translated in ttbl.store.paths_allowed.items():
-                        if img_name.startswith(path):
-                            img_name = img_name.replace(path, path_translated, 1)
-                            break
-                    else:
+                    file_name = _paths_allowed_translate(img_name)
+                    if file_name == None:
                         raise PermissionError(
                             "%s: absolute image path tries to read from"
                             " a location that is not allowed" % img_name)
-                    file_name = img_name
-                # we need to lock, since other processes might be
-                # trying to decompress the file at the same time
-                # We want to have the lock in another directory
-                # because the source directory where the file name
-                # might be might not be writable to us
-                lock_file_name = os.path.join(
-                    target.state_dir,
-                    "images.flash.decompress."
-                    + commonl.mkid(file_name)
-                    + ".lock")
-                with ttbl.process_posix_file_lock_c(lock_file_name):
-                    # if a decompressor crashed, we have no way to
-                    # tell if the decompressed file is correct or
-                    # truncated and thus corrupted -- we need manual
-                    # for that
-                    real_file_name = commonl.maybe_decompress(file_name)
+                file_names.append(( impl, img_type_real, file_name ))
+
+            # decompress whatever needs it; the decompressors are
+            # external programs, so when there are multiple, run them
+            # in parallel
+            compressed = list(dict.fromkeys(
+                file_name for _impl, _img_type_real, file_name in file_names
+                if commonl.file_is_compressed(file_name)[1]))
+            if len(compressed) < 2:
+                decompressed = dict(
+                    ( file_name, self._decompress(target, file_name) )
+                    for file_name in compressed)
+            else:
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers = min(len(compressed),
+                                          os.cpu_count() or 1)) as executor:
+                    decompressed = dict(zip(
+                        compressed,
+                        executor.map(lambda file_name:
+                                     self._decompress(target, file_name),
+                                     compressed)))
+
+            # flashers that work serially bucketed separated from the
+            # ones that can do parallel
+            serial = {}
+            parallel = {}
+            hashes_known = {}
+            for impl, img_type_real, file_name in file_names:
+                real_file_name = decompressed.get(file_name, file_name)
                 if impl.parallel:
-                    parallel[impl][img_type_real] = real_file_name
+                    parallel.setdefault(impl, {})[img_type_real] = real_file_name
                 else:
-                    serial[impl][img_type_real] = real_file_name
+                    serial.setdefault(impl, {})[img_type_real] = real_file_name
+                # before touching it, as that changes its signature
+                hexdigest = self._hash_known(target, img_type_real,
+                                             real_file_name)
+                if hexdigest:
+                    hashes_known[real_file_name] = hexdigest
                 if real_file_name.startswith(user_path):
                     # modify the mtime, so the file storage cleanup knows
                     # we are still using this file and doesn't not attempt
                     # to clean it up too soon
                     commonl.file_touch(real_file_name)
             target.timestamp()
-            # iterate over the real implementations only
-            for impl, subimages in serial.items():
+            # hash the images in the background while they are being
+            # flashed, instead of re-reading them after;
+            # _hash_record() picks the results up when each flasher
+            # is done. Created per call, since we run in forked
+            # daemon processes.
+            #
+            # hashlib releases the GIL while hashing, so multiple
+            # images get hashed in parallel.
+            real_file_names = set()
+            for subimages in list(serial.values()) + list(parallel.values()):
+                real_file_names.update(subimages.values())
+            hashes = {}
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers = min(len(real_file_names), 8) or 1)
+            try:
+                for real_file_name in real_file_names:
+                    if real_file_name in hashes_known:
+                        # touched since, so take the signature again
+                        hashes[real_file_name] = concurrent.futures.Future()
+                        hashes[real_file_name].set_result((
+                            _file_signature(real_file_name),
+                            hashes_known[real_file_name] ))
+                    else:
+                        hashes[real_file_name] = executor.submit(
+                            _hash_file, real_file_name)
+                # iterate over the real implementations only
+                #
                 # Serial implementation we just fake like it is
                 # parallel, but with a single implementation at the
-                # same time
-                self._flash_parallel(target, { impl: subimages },
-                                     impl.power_sequence_pre,
-                                     impl.power_sequence_post)
-            # FIXME: collect diagnostics here of what failed only if
-            # 'admin' or some other role?
-            if parallel:
-                self._flash_parallel(target, parallel,
-                                     self.power_sequence_pre,
-                                     self.power_sequence_post)
+                # same time; consecutive ones that declare
+                # *power_sequence_shareable* and need the same power
+                # sequences are grouped so the sequences run only once
+                # for all of them (avoids power cycling in between);
+                # anything else gets its own run, as it might rely on
+                # the reset.
+                phases = []
+                impl_prev = None
+                for impl, subimages in serial.items():
+                    if impl_prev \
+                       and impl_prev.power_sequence_shareable \
+                       and impl.power_sequence_shareable \
+                       and phases[-1][0] == impl.power_sequence_pre \
+                       and phases[-1][1] == impl.power_sequence_post:
+                        phases[-1][2].append({ impl: subimages })
+                    else:
+                        phases.append(( impl.power_sequence_pre,
+                                        impl.power_sequence_post,
+                                        [ { impl: subimages } ] ))
+                    impl_prev = impl
+                for power_sequence_pre, power_sequence_post, parallels \
+                    in phases:
+                    self._flash_parallel(target, parallels,
+                                         power_sequence_pre,
+                                         power_sequence_post, hashes)
+                # FIXME: collect diagnostics here of what failed only if
+                # 'admin' or some other role?
+                if parallel:
+                    self._flash_parallel(target, [ parallel ],
+                                         self.power_sequence_pre,
+                                         self.power_sequence_post, hashes)
+            finally:
+                # if flashing failed, don't bother hashing what is left
+                # nor wait for the hashes being taken to finish, as
+                # nobody will look at them (and on success they all
+                # are done by now)
+                executor.shutdown(wait = False, cancel_futures = True)
             return {}
 
 
@@ -802,6 +1068,60 @@ class interface(ttbl.tt_interface):
             result = list(self.aliases.keys()) + list(self.impls.keys()))
 
 
+def _image_single(images):
+    # For drivers that flash only one image at a time; return its
+    # type and file name
+    if len(images) != 1:
+        raise RuntimeError(
+            "only one image supported, got %d: %s"
+            % (len(images), " ".join("%s:%s" % (k, v)
+                                     for k, v in images.items())))
+    return next(iter(images.items()))
+
+
+def _flash_tool_run(target, cmdline, what = "flashing"):
+    # Run a flashing tool (or helper) to completion from /tmp,
+    # logging what we run and its output; on failure, log it and
+    # raise subprocess.CalledProcessError
+    cmdline_s = " ".join(cmdline)
+    target.log.info("%s with: %s", what, cmdline_s)
+    try:
+        output = subprocess.check_output(
+            cmdline, stdin = None, cwd = "/tmp",
+            stderr = subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        target.log.error("%s with %s failed: (%d) %s",
+                         what, cmdline_s, e.returncode, e.output)
+        raise
+    target.log.info("%s with %s: done", what, cmdline_s)
+    target.log.debug("%s with %s: output: %s", what, cmdline_s, output)
+    return output
+
+
+def _serial_1200bps_erase(target, serial_port, wait = 0.25):
+    # Arduino Due and others erase their flash when the programming
+    # port is opened at 1200bps (see bossac_c). Nothing on the port
+    # tells us when that has been picked up (no data, no modem line
+    # changes to select() on), hence the fixed wait, which
+    # experimentation found to be enough.
+    #
+    # Setting the line speed with termios on a raw descriptor is all
+    # that is needed; HUPCL ensures DTR drops on close, which is what
+    # the bootloaders key on.
+    target.log.debug("erasing the flash")
+    fd = os.open(serial_port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    try:
+        attrs = termios.tcgetattr(fd)
+        attrs[2] |= termios.HUPCL		# cflag
+        attrs[4] = termios.B1200		# ispeed
+        attrs[5] = termios.B1200		# ospeed
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        time.sleep(wait)
+    finally:
+        os.close(fd)
+    target.log.info("erased the flash")
+
+
 class arduino_cli_c(impl_c):
     """Flash with the `Arduino CLI <https://www.arduino.cc/pro/cli>`
 
@@ -902,12 +1222,12 @@ class arduino_cli_c(impl_c):
     #: >>> imager.path =  "/usr/local/bin/arduino-cli"
     path = "/usr/local/bin/arduino-cli"
 
+    #: Sketch FQBNs of boards whose flash has to be erased (by opening
+    #: the serial port at 1200bps) before uploading
+    erase_sketch_fqbns = frozenset([ "arduino:sam:arduino_due_x_dbg" ])
+
     def flash(self, target, images):
-        assert len(images) == 1, \
-            "only one image suported, got %d: %s" \
-            % (len(images), " ".join("%s:%s" % (k, v)
-                                     for k, v in list(images.items())))
-        image_name = list(images.values())[0]
+        image_type, image_name = _image_single(images)
 
         if self.serial_port == None:
             serial_port = "/dev/tty-%s" % target.id
@@ -915,7 +1235,7 @@ class arduino_cli_c(impl_c):
             serial_port = self.serial_port
 
         # remember this only handles one image type
-        bsp = list(images.keys())[0].replace("kernel-", "")
+        bsp = image_type.replace("kernel-", "")
         sketch_fqbn = self.sketch_fqbn
         if sketch_fqbn == None:
             # get the Sketch FQBN from the tags for the BSP
@@ -928,12 +1248,8 @@ class arduino_cli_c(impl_c):
                     % (target.id, bsp))
 
         # Arduino Dues and others might need a flash erase
-        if sketch_fqbn in [ "arduino:sam:arduino_due_x_dbg" ]:
-            # erase the flash by opening the serial port at 1200bps
-            target.log.debug("erasing the flash")
-            with serial.Serial(port = serial_port, baudrate = 1200):
-                time.sleep(0.25)
-            target.log.info("erased the flash")
+        if sketch_fqbn in self.erase_sketch_fqbns:
+            _serial_1200bps_erase(target, serial_port)
 
         # now write it
         cmdline = [
@@ -944,17 +1260,7 @@ class arduino_cli_c(impl_c):
             "--verbose",
             "--input", image_name
         ]
-        target.log.info("flashing image with: %s" % " ".join(cmdline))
-        try:
-            subprocess.check_output(
-                cmdline, stdin = None, cwd = "/tmp",
-                stderr = subprocess.STDOUT)
-            target.log.info("ran %s" % (" ".join(cmdline)))
-        except subprocess.CalledProcessError as e:
-            target.log.error("flashing with %s failed: (%d) %s"
-                             % (" ".join(cmdline),
-                                e.returncode, e.output))
-            raise
+        _flash_tool_run(target, cmdline)
         target.log.info("flashed image")
 
 
@@ -1044,11 +1350,7 @@ class bossac_c(impl_c):
     path = "/usr/bin/bossac"
 
     def flash(self, target, images):
-        assert len(images) == 1, \
-            "only one image suported, got %d: %s" \
-            % (len(images), " ".join("%s:%s" % (k, v)
-                                     for k, v in list(images.items())))
-        image_name = list(images.values())[0]
+        _image_type, image_name = _image_single(images)
 
         if self.serial_port == None:
             serial_port = "/dev/tty-%s" % target.id
@@ -1065,11 +1367,7 @@ class bossac_c(impl_c):
         # the whole thing and then someone else will power it on
         target.console.put_disable(target, ttbl.who_daemon(),
                                    dict(component = console), None, None)
-        # erase the flash by opening the serial port at 1200bps
-        target.log.debug("erasing the flash")
-        with serial.Serial(port = serial_port, baudrate = 1200):
-            time.sleep(0.25)
-        target.log.info("erased the flash")
+        _serial_1200bps_erase(target, serial_port)
 
         # now write it
         cmdline = [
@@ -1081,21 +1379,61 @@ class bossac_c(impl_c):
             "-b",	# Boot from Flash
             image_name
         ]
-        target.log.info("flashing image with: %s" % " ".join(cmdline))
-        try:
-            subprocess.check_output(
-                cmdline, stdin = None, cwd = "/tmp",
-                stderr = subprocess.STDOUT)
-            target.log.info("ran %s" % (" ".join(cmdline)))
-        except subprocess.CalledProcessError as e:
-            target.log.error("flashing with %s failed: (%d) %s"
-                             % (" ".join(cmdline),
-                                e.returncode, e.output))
-            raise
+        _flash_tool_run(target, cmdline)
         target.power.put_off(target, ttbl.who_daemon(), {}, None, None)
         target.log.info("flashed image")
 
 
+def _uevent_socket():
+    # Subscribe to the kernel's device events; None if we can't, in
+    # which case callers just skip waiting for them
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                             socket.NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, 1))	# pid autoassigned, kernel group
+    except (AttributeError, OSError):
+        return None
+    sock.setblocking(False)
+    return sock
+
+
+def _uevent_wait_dfu(target, sock, usb_serial_number, timeout):
+    # Wait for a USB DFU interface (class 254, subclass 1) to be added
+    # on the device with the given USB serial number; kernel uevents
+    # carry no serial numbers, so get it from the device in sysfs
+    ts0 = time.monotonic()
+    while True:
+        remaining = ts0 + timeout - time.monotonic()
+        if remaining <= 0:
+            target.log.info("DFU device %s not seen after %.1fs",
+                            usb_serial_number, timeout)
+            return False
+        if not select.select([ sock ], [], [], remaining)[0]:
+            continue
+        try:
+            data = sock.recv(16384)
+        except BlockingIOError:
+            continue
+        fields = {}
+        for field in data.split(b"\0")[1:]:
+            key, _, value = field.partition(b"=")
+            fields[key] = value
+        if fields.get(b'ACTION') != b'add' \
+           or fields.get(b'DEVTYPE') != b'usb_interface' \
+           or not fields.get(b'INTERFACE', b'').startswith(b'254/1/'):
+            continue
+        devpath = "/sys" + fields.get(b'DEVPATH', b'').decode('utf-8')
+        try:
+            with open(os.path.join(os.path.dirname(devpath), "serial")) as f:
+                if f.read().strip() != usb_serial_number:
+                    continue
+        except OSError:
+            continue
+        target.log.info("DFU device %s seen after %.1fs",
+                        usb_serial_number, time.monotonic() - ts0)
+        return True
+
+
 class dfu_c(impl_c):
     """Flash the target with `DFU util <http://dfu-util.sourceforge.net/>`_
 
@@ -1110,6 +1448,16 @@ class dfu_c(impl_c):
 
     :param str usb_serial_number: target's USB Serial Number
 
+    :param float uevent_timeout: (optional; default 1) seconds to
+      wait after power cycling for the DFU interface to show up
+      before running *dfu-tool* anyway; *0* runs it right away.
+
+      The board stays in DFU mode for about five seconds and
+      *dfu-tool* has to be done before it leaves, so this can't be
+      more than two seconds. Note when the DFU interface is not
+      seen (eg: the hub reports it differently), this is added
+      before *dfu-tool* is started.
+
     Other parameters described in :class:ttbl.images.impl_c.
 
     *Requirements*
@@ -1227,11 +1575,16 @@ class dfu_c(impl_c):
     >>> )
     """
 
-    def __init__(self, usb_serial_number, **kwargs):
+    def __init__(self, usb_serial_number, uevent_timeout = 1, **kwargs):
         assert usb_serial_number == None \
             or isinstance(usb_serial_number, str)
+        assert isinstance(uevent_timeout, numbers.Real) \
+            and 0 <= uevent_timeout <= 2, \
+            "uevent_timeout: expected 0 to 2 seconds, so dfu-tool runs" \
+            " before the board leaves DFU mode; got %s" % uevent_timeout
         impl_c.__init__(self, **kwargs)
         self.usb_serial_number = usb_serial_number
+        self.uevent_timeout = uevent_timeout
         self.upid_set("USB DFU flasher", usb_serial_number = usb_serial_number)
 
     #: Path to the dfu-tool
@@ -1246,8 +1599,21 @@ class dfu_c(impl_c):
     #: >>> imager.path =  "/usr/local/bin/dfu-tool"
     path = "/usr/bin/dfu-tool"
 
+    #: Transfer size (bytes) to ask *dfu-tool* to use
+    #:
+    #: By default (*None*) it uses the size the device reports in its
+    #: DFU functional descriptor; devices that report a small one can
+    #: be made faster with, eg:
+    #:
+    #: >>> imager = ttbl.images.dfu_c(SERIAL)
+    #: >>> imager.transfer_size = 4096
+    transfer_size = None
+
     def flash(self, target, images):
         cmdline = [ self.path, "-S", self.usb_serial_number ]
+        if self.transfer_size:
+            cmdline += [ "--transfer-size", str(self.transfer_size) ]
+        bsps = target.tags.get('bsps', {})
         # for each image we are writing to a different interface, we
         # add a -a IFNAME -D IMGNAME to the commandline, so we can
         # flash multiple images in a single shot
@@ -1256,13 +1622,13 @@ class dfu_c(impl_c):
             if not image_type.startswith("kernel-"):
                 raise RuntimeError(
                     "Unknown image type '%s' (valid: kernel-{%s})"
-                    % (image_type, ",".join(list(target.tags['bsps'].keys()))))
+                    % (image_type, ",".join(bsps)))
             bsp = image_type.replace("kernel-", "")
-            tags_bsp = target.tags.get('bsps', {}).get(bsp, None)
+            tags_bsp = bsps.get(bsp, None)
             if tags_bsp == None:
                 raise RuntimeError(
                     "Unknown BSP %s from image type '%s' (valid: %s)"
-                    % (bsp, image_type, " ".join(list(target.tags['bsps'].keys()))))
+                    % (bsp, image_type, " ".join(bsps)))
             dfu_if_name = tags_bsp.get('dfu_interface_name', None)
             if dfu_if_name == None:
                 raise RuntimeError(
@@ -1272,20 +1638,42 @@ class dfu_c(impl_c):
                     % (image_type, bsp))
             cmdline += [ "-a", dfu_if_name, "-D", image_name ]
 
+        # the power cycle takes a while; have the kernel start reading
+        # the images meanwhile, so dfu-tool finds them in the page
+        # cache instead of waiting on the disk
+        for image_name in images.values():
+            fd = os.open(image_name, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
         # Power cycle the board so it goes into DFU mode; it then
         # stays there for five seconds (FIXME: all of them?)
-        target.power.put_cycle(target, ttbl.who_daemon(), {}, None, None)
+        #
+        # Listen for device events before, so we see the DFU
+        # interface come up and start dfu-tool right then; if we
+        # can't listen or don't see it soon (serial number mismatch,
+        # hub reporting differently...), we start dfu-tool anyway,
+        # which will retry--but never wait long enough to miss the
+        # DFU mode window.
+        if self.uevent_timeout > 0:
+            sock = _uevent_socket()
+        else:
+            sock = None
+        try:
+            target.power.put_cycle(target, ttbl.who_daemon(),
+                                   {}, None, None)
+            if sock:
+                _uevent_wait_dfu(
+                    target, sock, self.usb_serial_number,
+                    self.uevent_timeout)
+        finally:
+            if sock:
+                sock.close()
 
         # let's do this
-        try:
-            target.log.info("flashing image with: %s" % " ".join(cmdline))
-            subprocess.check_output(cmdline, cwd = "/tmp",
-                                    stderr = subprocess.STDOUT)
-            target.log.info("flashed with %s: %s" % (" ".join(cmdline)))
-        except subprocess.CalledProcessError as e:
-            target.log.error("flashing with %s failed: (%d) %s" %
-                             (" ".join(cmdline), e.returncode, e.output))
-            raise
+        _flash_tool_run(target, cmdline)
         target.power.put_off(target, ttbl.who_daemon(), {}, None, None)
         target.log.info("flashed image")
 
@@ -1310,16 +1698,18 @@ class fake_c(impl2_c):
         impl2_c.__init__(self, **kwargs)
         self.upid_set("Fake test flasher", _id = str(id(self)))
 
+    # the context lives for the whole flashing operation, in this
+    # process, so there is no need to go through the target's fsdb
     def flash_start(self, target, images, context):
-        target.fsdb.set(f"fake-{'.'.join(images.keys())}-{context}.ts0", time.time())
+        context['fake_ts0'] = time.time()
 
     def flash_check_done(self, target, images, context):
-        ts0 = target.fsdb.get(f"fake-{'.'.join(images.keys())}-{context}.ts0", None)
         ts = time.time()
-        return ts - ts0 > self.estimated_duration - self.check_period
+        return ts - context['fake_ts0'] \
+            > self.estimated_duration - self.check_period
 
     def flash_kill(self, target, images, context, msg):
-        target.fsdb.set(f"fake-{'.'.join(images.keys())}-{context}.state", "started", None)
+        context['fake_state'] = "killed"
 
     def flash_post_check(self, target, images, context):
         return None
@@ -1405,11 +1795,24 @@ class esptool_c(impl_c):
     #: >>> imager.path =  "/usr/local/bin/esptool.py"
     path = "__unconfigured__ttbl.images.esptool_c.path__"
 
+    #: Directory where to place the converted *bin* image
+    #:
+    #: Defaults to tmpfs; if it does not exist, the system's default
+    #: temporary directory is used.
+    tmpdir = "/dev/shm"
+
+    #: Send the image compressed to the target
+    #:
+    #: The bootloader decompresses it, so a lot less data goes over
+    #: the serial port; disabled by default as some older boot ROMs
+    #: fail with it. Enable with:
+    #:
+    #: >>> imager = ttbl.images.esptool_c(SERIAL)
+    #: >>> imager.compress = True
+    compress = False
+
     def flash(self, target, images):
-        assert len(images) == 1, \
-            "only one image suported, got %d: %s" \
-            % (len(images), " ".join("%s:%s" % (k, v)
-                                     for k, v in list(images.items())))
+        _image_type, image_name = _image_single(images)
         if self.serial_port == None:
             serial_port = "/dev/tty-%s" % target.id
         else:
@@ -1432,7 +1835,7 @@ class esptool_c(impl_c):
             "--before", "default_reset",
 	    # with no power control, at least it starts
             "--after", "hard_reset",
-            "write_flash", "-u",
+            "write_flash", "--compress" if self.compress else "-u",
             "--flash_mode", "dio",
             "--flash_freq", "40m",
             "--flash_size", "detect",
@@ -1440,40 +1843,37 @@ class esptool_c(impl_c):
         ]
 
         image_type = 'kernel'
-        image_name = list(images.values())[0]
-        image_name_bin = image_name + ".bin"
+        # the converted image is only needed until write_flash reads
+        # it, so keep it in tmpfs if available; it can't be a pipe
+        # since esptool.py needs to know the size and seek
+        fd, image_name_bin = tempfile.mkstemp(
+            prefix = "ttbl-esptool-", suffix = ".bin",
+            dir = self.tmpdir if os.path.isdir(self.tmpdir) else None)
+        os.close(fd)
         try:
-            cmdline = cmdline_convert + [ image_name,
-                                          "--output", image_name_bin ]
-            target.log.info("%s: converting with %s"
-                            % (image_type, " ".join(cmdline)))
-            s = subprocess.check_output(cmdline, cwd = "/tmp",
-                                        stderr = subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            target.log.error("%s: converting image with %s failed: (%d) %s"
-                             % (image_type, " ".join(cmdline),
-                                e.returncode, e.output))
-            raise
-
-        target.power.put_cycle(target, ttbl.who_daemon(), {}, None, None)
-        # give up the serial port, we need it to flash
-        # we don't care it is off because then we are switching off
-        # the whole thing and then someone else will power it on
-        target.console.put_disable(target, ttbl.who_daemon(),
-                                   dict(component = console), None, None)
-        try:
-            cmdline = cmdline_flash + [ image_name_bin ]
-            target.log.info("%s: flashing with %s"
-                            % (image_type, " ".join(cmdline)))
-            s = subprocess.check_output(cmdline, cwd = "/tmp",
-                                        stderr = subprocess.STDOUT)
-            target.log.info("%s: flashed with %s: %s"
-                            % (image_type, " ".join(cmdline), s))
-        except subprocess.CalledProcessError as e:
-            target.log.error("%s: flashing with %s failed: (%d) %s"
-                             % (image_type, " ".join(cmdline),
-                                e.returncode, e.output))
-            raise
+            # converting doesn't need the target, so do it while we
+            # power cycle it, so esptool.py's startup time overlaps
+            with concurrent.futures.ThreadPoolExecutor(max_workers = 1) \
+                 as executor:
+                convert = executor.submit(
+                    _flash_tool_run, target,
+                    cmdline_convert
+                    + [ image_name, "--output", image_name_bin ],
+                    what = image_type + ": converting image")
+                target.power.put_cycle(target, ttbl.who_daemon(),
+                                       {}, None, None)
+                # give up the serial port, we need it to flash
+                # we don't care it is off because then we are
+                # switching off the whole thing and then someone else
+                # will power it on
+                target.console.put_disable(
+                    target, ttbl.who_daemon(),
+                    dict(component = console), None, None)
+                convert.result()
+            _flash_tool_run(target, cmdline_flash + [ image_name_bin ],
+                            what = image_type + ": flashing")
+        finally:
+            commonl.rm_f(image_name_bin)
         target.power.put_off(target, ttbl.who_daemon(), {}, None, None)
         target.log.info("%s: flashing succeeded" % image_type)
 
@@ -1520,12 +1920,28 @@ class flash_shell_cmd_c(impl2_c):
 
     :param dict env_add: (optional) variables to add to the environment when
       running the command
+
+    :param bool close_fds: (optional; default *True*) close or not all
+      file descriptors before running the command; see
+      :python:`subprocess.Popen` for more information.
+
+      It defaults to *True* because descriptors opened by C libraries
+      (eg: USB access) might be inheritable and a long lived flasher
+      holding them open can keep devices busy.
+
+      Setting it to *False* doesn't make starting the flasher
+      noticeably faster: with Python >= 3.10 on Linux
+      :class:`subprocess.Popen` uses *vfork()* either way and on
+      Linux >= 5.9 closing the descriptors is a single
+      *close_range()* call.
     """
     def __init__(self, cmdline, cwd = "/tmp", path = None, env_add = None,
-                 **kwargs):
+                 close_fds = True, **kwargs):
         commonl.assert_list_of_strings(cmdline, "cmdline", "arguments")
         assert cwd == None or isinstance(cwd, str)
         assert path == None or isinstance(path, str)
+        assert isinstance(close_fds, bool)
+        self.close_fds = close_fds
         self.p = None
         if path == None:
             path = cmdline[0]
@@ -1537,6 +1953,10 @@ class flash_shell_cmd_c(impl2_c):
             self.env_add = env_add
         else:
             self.env_add = {}
+        # environment for the flasher, rebuilt only when env_add
+        # changes (subclasses modify it before calling flash_start())
+        self._env = None
+        self._env_add = None
         impl2_c.__init__(self, **kwargs)
 
     def flash_start(self, target, images, context):
@@ -1555,11 +1975,9 @@ class flash_shell_cmd_c(impl2_c):
         context.setdefault('kws', {}).update(kws)
         kws = context['kws']
 
-        count = 0
-        for image_name, image in images.items():
+        for count, (image_name, image) in enumerate(images.items()):
             kws['image.' + image_name] = image
             kws['image.#%d' % count ] = image
-            count += 1
 
         pidfile = "%(path)s/flash-%(image_types)s.pid" % kws
         context['pidfile'] = kws['pidfile'] = pidfile
@@ -1577,12 +1995,13 @@ class flash_shell_cmd_c(impl2_c):
         context['logfile_name'] = kws['logfile_name'] = logfile_name
 
         cmdline = []
-        count = 0
         try:
-            for i in self.cmdline:
+            for count, i in enumerate(self.cmdline):
+                if '%' not in i:	# most are literals, nothing to format
+                    cmdline.append(i)
+                    continue
                 # some older Linux distros complain if this string is unicode
                 cmdline.append(str(i % kws))
-            count += 1
         except KeyError as e:
             message = "configuration error? can't template command line #%d," \
                 " missing field or target property: %s" % (count, e)
@@ -1593,8 +2012,11 @@ class flash_shell_cmd_c(impl2_c):
         context['cmdline_s'] = cmdline_s
 
         if self.env_add:
-            env = dict(os.environ)
-            env.update(self.env_add)
+            if self._env_add != self.env_add:
+                self._env = dict(os.environ)
+                self._env.update(self.env_add)
+                self._env_add = dict(self.env_add)
+            env = self._env
         else:
             env = os.environ
 
@@ -1602,14 +2024,26 @@ class flash_shell_cmd_c(impl2_c):
         context['ts0'] = ts0
         try:
             target.log.info("flashing %s image with: %s",
-                            image_types, " ".join(cmdline))
-            with open(logfile_name, "w+") as logf:
+                            image_types, cmdline_s)
+            # the child only needs the descriptors, no Python file
+            # objects for these
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC
+            logfd = os.open(logfile_name, flags, 0o666)
+            try:
+                # Popen uses vfork() on Linux since Python 3.10, so the
+                # daemon's size doesn't make starting the flasher slower
                 self.p = subprocess.Popen(
                     cmdline, env = env, stdin = None, cwd = cwd,
                     bufsize = 0,	# output right away, to monitor
-                    stderr = subprocess.STDOUT, stdout = logf)
-            with open(pidfile, "w+") as pidf:
-                pidf.write("%s" % self.p.pid)
+                    close_fds = self.close_fds,
+                    stderr = subprocess.STDOUT, stdout = logfd)
+            finally:
+                os.close(logfd)
+            fd = os.open(pidfile, flags, 0o666)
+            try:
+                os.write(fd, b"%d" % self.p.pid)
+            finally:
+                os.close(fd)
             target.log.debug("%s: flasher PID %s file %s",
                              image_types, self.p.pid, pidfile)
         except subprocess.CalledProcessError as e:
@@ -1622,32 +2056,53 @@ class flash_shell_cmd_c(impl2_c):
             msg = "flashing  with %s failed to start: (%s->%s) %s" % (
                 cmdline_s, self.p.pid, self.p.returncode, logfile_name)
             target.log.error(msg)
-            with open(logfile_name) as logf:
-                for line in logf:
-                    target.log.error('%s: logfile: %s', image_types, line)
+            # just the tail and in one go, the log could be huge
+            target.log.error('%s: logfile tail: %s', image_types,
+                             self._log_file_read(context))
             raise RuntimeError(msg)
         # this is needed so SIGCHLD the process and it doesn't become
         # a zombie
         ttbl.daemon_pid_add(self.p.pid)	# FIXME: race condition if it died?
+        # a pidfd becomes readable when the process exits, so checking
+        # it is cheaper than poll()'s waitpid(); if we can't get one
+        # (old kernel/Python, or it is already gone) we just poll()
+        try:
+            context['pidfd'] = os.pidfd_open(self.p.pid)
+        except (AttributeError, OSError):
+            pass
         target.log.debug("%s: flasher PID %s started (%s)",
                          image_types, self.p.pid, cmdline_s)
         return
 
 
+    def _pidfd_close(self, context):
+        pidfd = context.pop('pidfd', None)
+        if pidfd != None:
+            os.close(pidfd)
+
+
     def flash_check_done(self, target, images, context):
-        ts = time.time()
-        ts0 = context['ts0']
-        target.log.debug("%s: [+%.1fs] flasher PID %s checking",
-                         context['kws']['image_types'], ts - ts0, self.p.pid)
-        self.p.poll()
-        if self.p.returncode == None:
+        # non-blocking: no thread sits waiting on each flasher; note
+        # we can't reap with a shared os.waitid(P_ALL) here, since
+        # the daemon's SIGCHLD handler already peeks with WNOWAIT and
+        # reaping others' PIDs would steal Popen's exit status
+        pidfd = context.get('pidfd', None)
+        if pidfd != None and not select.select([ pidfd ], [], [], 0)[0]:
             r = False
         else:
-            r = True
-        ts = time.time()
-        target.log.debug(
-            "%s: [+%.1fs] flasher PID %s checked %s",
-            context['kws']['image_types'], ts - ts0, self.p.pid, r)
+            self.p.poll()
+            if self.p.returncode == None:
+                r = False
+            else:
+                r = True
+                self._pidfd_close(context)
+        # this is called every check period, so log once and only
+        # get the timestamp if we are going to
+        if target.log.isEnabledFor(logging.DEBUG):
+            target.log.debug(
+                "%s: [+%.1fs] flasher PID %s checked %s",
+                context['kws']['image_types'],
+                time.time() - context['ts0'], self.p.pid, r)
         return r
 
 
@@ -1657,10 +2112,31 @@ class flash_shell_cmd_c(impl2_c):
         target.log.debug(
             "%s: [+%.1fs] flasher PID %s terminating due to timeout",
             context['kws']['image_types'], ts - ts0, self.p.pid)
-        commonl.process_terminate(context['pidfile'], path = self.path)
+        pidfd = context.get('pidfd', None)
+        if pidfd == None:
+            # we know the PID, no need to read it back from the
+            # pidfile; still have it removed
+            commonl.process_terminate(self.p.pid,
+                                      pidfile = context['pidfile'],
+                                      path = self.path)
+            return
+        # with a pidfd we can't signal some other process that got
+        # the PID recycled, and we know as soon as it dies; same
+        # TERM and KILL after 0.25s as commonl.process_terminate()
+        try:
+            signal.pidfd_send_signal(pidfd, signal.SIGTERM)
+            if not select.select([ pidfd ], [], [], 0.25)[0]:
+                signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+        except ProcessLookupError:	# died already
+            pass
+        finally:
+            self._pidfd_close(context)
+            commonl.rm_f(context['pidfile'])
 
 
     def _log_file_read(self, context, max_bytes = 2000):
+        # Read only the tail; not mmap(), the log file is truncated
+        # when the next flash starts, which would SIGBUS us.
         try:
             with open(context['logfile_name'], 'rb') as logf:
                 try:
@@ -1670,7 +2146,9 @@ class flash_shell_cmd_c(impl2_c):
                 except IOError as e:
                     if e.errno != errno.EINVAL:
                         raise
-                return logf.read().decode('utf-8')
+                # we might have seeked into the middle of a character
+                return logf.read(max_bytes).decode('utf-8',
+                                                   errors = 'replace')
         except IOError as e:
             if e.errno != errno.ENOENT:
                 raise
@@ -1692,11 +2170,12 @@ class flash_shell_cmd_c(impl2_c):
             target.log.error(msg)
             return { "message": msg }
         return
-        # example, look at errors in the logfile
+        # example, look at errors in the logfile; search the bytes,
+        # no need to decode the whole log to find an ASCII string
         try:
-            with codecs.open(context['logfile_name'], errors = 'ignore') as logf:
+            with open(context['logfile_name'], 'rb') as logf:
                 for line in logf:
-                    if 'Fail' in line:
+                    if b'Fail' in line:
                         msg = "flashing with %s failed, issues in logfile" % (
                             context['cmdline_s'])
                         target.log.error(msg)
@@ -1934,8 +2413,9 @@ class quartus_pgm_c(flash_shell_cmd_c):
 
         # for each image we are burning, map it to a target name in
         # the cable (@NUMBER)
-        # make sure we don't modify the originals
-        cmdline = copy.deepcopy(self.cmdline_orig)
+        # make sure we don't modify the originals (strings, so a
+        # shallow copy does)
+        cmdline = list(self.cmdline_orig)
         for image_type, filename in images.items():
             target_index = self.image_map.get(image_type, None)
             # pass only the realtive filename, as we are going to
@@ -1947,12 +2427,12 @@ class quartus_pgm_c(flash_shell_cmd_c):
         self.cmdline = cmdline
 
         if self.jtagconfig:
+            cmdline_setparam = [
+                self.path_jtagconfig,
+                "--setparam", "%s [%s]" % (product, usb_path),
+            ]
             for option, value in self.jtagconfig.items():
-                cmdline = [
-                    self.path_jtagconfig,
-                    "--setparam", "%s [%s]" % (product, usb_path),
-                    option, value
-                ]
+                cmdline = cmdline_setparam + [ option, value ]
                 target.log.info("running per-config: %s" % " ".join(cmdline))
                 subprocess.check_output(
                     cmdline, shell = False, stderr = subprocess.STDOUT)
@@ -2186,4 +2666,6 @@ class sf100linux_c(flash_shell_cmd_c):
         if read_bytes != None:
             cmdline += [ "-l", str(read_bytes) ]
 
-        subprocess.check_output(cmdline, shell = False)
+        # the data goes to file_name, stdout is just chatter
+        subprocess.check_call(cmdline, shell = False,
+                              stdout = subprocess.DEVNULL)
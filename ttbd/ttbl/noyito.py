@@ -63,6 +63,12 @@ import ttbl._install
 import ttbl.capture
 import ttbl.power
 
+def _ncat_socket(target, component):
+    # Where reader_pc's multiplexor listens and channel_c's capturers
+    # connect; has to match reader_pc's command line template
+    return os.path.join(target.state_dir, f"{component}-ncat.socket")
+
+
 class reader_pc(ttbl.power.daemon_c):
     """
     Implement a multiplexor to read Noyitos' serial port to multiple users
@@ -110,12 +116,17 @@ class reader_pc(ttbl.power.daemon_c):
             cmdline = [
                 "/usr/bin/ncat",
                 "--listen", "--keep-open",
+                # readers only read; don't bother handling anything
+                # they might send
+                "--send-only",
                 "-U", '%(path)s/%(component)s-ncat.socket'
             ],
             check_path = "/usr/bin/ncat",
             **kwargs)
         self.serial_device = serial_device
         self.stdin = None
+        # pidfile names expanded by verify(), by (target, component)
+        self._pidfiles = {}
         self.upid_set(f"Noyito 12-bit 10 channel ADC @{serial_device}",
                       serial_device = serial_device)
 
@@ -124,24 +135,48 @@ class reader_pc(ttbl.power.daemon_c):
         # open serial port to set the baud rate, then ncat gets
         # started and it keeps the setting; default is 9600 8n1 no
         # flow control, so we explicitly set what the device needs 115200.
+        #
+        # ncat gets the port as its stdin, so it is fine for us to
+        # close it when done; we can't keep it to hand to the
+        # channel_c capturers, they might be started from another of
+        # the daemon's processes.
         with serial.Serial(self.serial_device, 115200) as f:
             self.stdin = f
             kws = dict(target.kws)
             kws['name'] = 'ncat'
             kws['component'] = component
-            commonl.rm_f(os.path.join(target.state_dir,
-                                      f"{component}-ncat.socket"))
+            commonl.rm_f(_ncat_socket(target, component))
+            # properties might have changed since the last power on
+            self._pidfiles.pop((target.id, component), None)
             ttbl.power.daemon_c.on(self, target, component)
 
 
     def verify(self, target, component, cmdline_expanded):
-        kws = dict(target.kws)
-        kws.update(self.kws)
-        # bring in runtime properties (override the rest)
-        kws.update(target.fsdb.get_as_dict())
-        kws['component'] = component
-        return commonl.process_alive(self.pidfile % kws, self.check_path) != None
+        # this is polled while ncat starts; expand the pidfile name
+        # (which needs reading all the runtime properties) only once
+        pidfile = self._pidfiles.get((target.id, component), None)
+        if pidfile == None:
+            kws = dict(target.kws)
+            kws.update(self.kws)
+            # bring in runtime properties (override the rest)
+            kws.update(target.fsdb.get_as_dict())
+            kws['component'] = component
+            pidfile = self.pidfile % kws
+            self._pidfiles[(target.id, component)] = pidfile
+        return commonl.process_alive(pidfile, self.check_path) != None
+
+
 
+_capture_program = None
+
+def _capture_program_locate():
+    # All channels use the same helper, look for it only once
+    global _capture_program
+    if _capture_program == None:
+        _capture_program = commonl.ttbd_locate_helper(
+            "noyito-capture.py", ttbl._install.share_path,
+            log = logging, relsrcpath = ".")
+    return _capture_program
 
 
 class channel_c(ttbl.capture.impl_c):
@@ -164,9 +199,7 @@ class channel_c(ttbl.capture.impl_c):
             **kwargs)
         self.noyito_component = noyito_component
         self.upid = noyito_obj.upid
-        self.capture_program = commonl.ttbd_locate_helper(
-            "noyito-capture.py", ttbl._install.share_path,
-            log = logging, relsrcpath = ".")
+        self.capture_program = _capture_program_locate()
         self.channell = []
         for channel, data in channels.items():
             assert isinstance(channel, int) and channel > 0 and channel <= 10, \
@@ -177,13 +210,15 @@ class channel_c(ttbl.capture.impl_c):
             assert mode in ( None, 'mode', 'bool', 'onoff' ), \
                 "channel mode has to be one of: None, mode, bool, onoff; " \
                 " got %s" % mode
-            name = data.get('mode', str(channel))
+            name = data.get('name', str(channel))
             assert isinstance(name, str), \
                 "name: expected a string; got %s" % type(name)
-            l = [ "%s" % channel ]
-            for name, val in data.items():
-                l.append("%s=%s" % (name, val))
-            self.channell.append(":".join(l))
+            self.channell.append(":".join(
+                [ str(channel) ]
+                + [ "%s=%s" % (key, val) for key, val in data.items() ]))
+
+    def _pidfile(self, target, capturer):
+        return os.path.join(target.state_dir, "capture-%s.pid" % capturer)
 
     def start(self, target, capturer, path):
         # power on the serial port capturer
@@ -193,24 +228,44 @@ class channel_c(ttbl.capture.impl_c):
 
         stream_filename = capturer + ".data.json"
         log_filename = capturer + ".capture.log"
-        pidfile = "%s/capture-%s.pid" % (target.state_dir, capturer)
-
-        logf = open(os.path.join(path, log_filename), "w+")
-        p = subprocess.Popen(
-            [
-                "stdbuf", "-e0", "-o0",
-                self.capture_program,
-                os.path.join(path, stream_filename),
-                "%s/%s-ncat.socket" % (target.state_dir, capturer),
-            ] + self.channell,
-            bufsize = -1,
-            close_fds = True,
-            shell = False,
-            stderr = subprocess.STDOUT, stdout = logf.buffer,
-        )
-
-        with open(pidfile, "w+") as pidf:
-            pidf.write("%s" % p.pid)
+        pidfile = self._pidfile(target, capturer)
+
+        # stdbuf would do nothing for a Python program, which doesn't
+        # use C stdio; tell Python itself not to buffer its output
+        env = dict(os.environ)
+        env['PYTHONUNBUFFERED'] = "1"
+        # the child only needs the descriptor
+        logfd = os.open(os.path.join(path, log_filename),
+                        os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC,
+                        0o666)
+        try:
+            p = subprocess.Popen(
+                [
+                    self.capture_program,
+                    os.path.join(path, stream_filename),
+                    # reader_pc's multiplexor, where all channels read
+                    _ncat_socket(target, self.noyito_component),
+                ] + self.channell,
+                bufsize = -1,
+                close_fds = True,
+                env = env,
+                shell = False,
+                stderr = subprocess.STDOUT, stdout = logfd,
+            )
+        finally:
+            os.close(logfd)		# the child has its own copy
+
+        # write it whole and then rename, so stop() never sees a half
+        # written pidfile and fails to kill
+        pidfile_new = pidfile + ".%d" % os.getpid()
+        fd = os.open(pidfile_new,
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC,
+                     0o666)
+        try:
+            os.write(fd, b"%d" % p.pid)
+        finally:
+            os.close(fd)
+        os.replace(pidfile_new, pidfile)
         ttbl.daemon_pid_add(p.pid)
 
         return True, {
@@ -220,6 +275,6 @@ class channel_c(ttbl.capture.impl_c):
 
 
     def stop(self, target, capturer, path):
-        pidfile = "%s/capture-%s.pid" % (target.state_dir, capturer)
+        pidfile = self._pidfile(target, capturer)
         commonl.process_terminate(pidfile, tag = "capture:" + capturer,
                                   wait_to_kill = 2)